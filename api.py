@@ -1,18 +1,82 @@
-# api.py
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-import utils
+import json
+import time
+import hashlib
+from fastapi import FastAPI, Request, Query
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
+import stats
+import config
+import webhook
+import heartbeat
+import metrics
+from cache import TTLCache, MISSING
 
 app = FastAPI()
 
 @app.api_route("/health", methods=["GET", "HEAD"])
 def health():
-    if utils.is_bot_running():
-        return JSONResponse(content={"status": "up"}, status_code=200)
-    else:
-        return JSONResponse(content={"status": "down"}, status_code=503)
+    report = heartbeat.status()
+    if report["status"] == "down":
+        return JSONResponse(content=report, status_code=503)
+    return JSONResponse(content=report, status_code=200)
+
+# Rendered /stat bodies, keyed by query; the bot flushes counters every few seconds anyway
+STAT_CACHE = TTLCache(256, config.STAT_CACHE_SECONDS)
+STAT_DEFAULT_WINDOW = {"minute": 3600, "hour": 48 * 3600}
+STAT_MAX_POINTS = 5000
+
+def render_stat(resolution: str | None, start: int | None, end: int | None) -> tuple:
+    stat_data = stats.load_stat()
+    if resolution:
+        seconds = stats.RESOLUTIONS[resolution]
+        end = end if end is not None else int(time.time()) + 1
+        start = start if start is not None else end - STAT_DEFAULT_WINDOW[resolution]
+        start = max(start, end - STAT_MAX_POINTS * seconds)
+        stat_data["range"] = {"resolution": resolution, "from": start, "to": end}
+        stat_data["series"] = stats.load_series(resolution, start, end)
+    body = json.dumps(stat_data).encode()
+    return body, '"' + hashlib.sha1(body).hexdigest() + '"'
 
 @app.get("/stat")
-def stat():
-    stat_data = utils.load_stat()
-    return stat_data
+def stat(
+    request: Request,
+    resolution: str | None = None,
+    start: int | None = Query(None, alias="from"),
+    end: int | None = Query(None, alias="to"),
+):
+    if resolution is not None and resolution not in stats.RESOLUTIONS:
+        return JSONResponse(content={"error": f"resolution must be one of {list(stats.RESOLUTIONS)}"}, status_code=400)
+
+    key = (resolution, start, end)
+    cached = STAT_CACHE.get(key)
+    if cached is MISSING:
+        cached = render_stat(resolution, start, end)
+        STAT_CACHE.set(key, cached)
+    body, etag = cached
+
+    headers = {"ETag": etag, "Cache-Control": f"max-age={int(config.STAT_CACHE_SECONDS)}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.scrape(), media_type="text/plain; version=0.0.4")
+
+@app.post(config.WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    # Updates are only accepted when bot2.py runs this app in webhook mode
+    if not webhook.ACTIVE.is_set():
+        return JSONResponse(content={"ok": False}, status_code=503)
+    if not webhook.check_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+        webhook.stats["rejected"] += 1
+        return JSONResponse(content={"ok": False}, status_code=403)
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        return JSONResponse(content={"ok": False}, status_code=400)
+    # A non-2xx answer makes Telegram redeliver the update later
+    if not webhook.enqueue(payload):
+        return JSONResponse(content={"ok": False}, status_code=503)
+    return {"ok": True}
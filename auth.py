@@ -1,10 +1,17 @@
 import re
+import time
 import requests
-import utils
 import os
+import threading
 
-API_TOKEN = utils.load_token("BEQUICK")
-API_URL = "https://pondmobile-atom-api.bequickapps.com"
+import bequick
+import config
+import log
+from cache import TTLCache, MISSING
+from singleflight import SingleFlight
+
+LOG = log.get("auth")
+BEQUICK_LOG = log.get("bequick.lines")
 
 def normalize_mdn(phone_number: str) -> str:
     digits = re.sub(r"\D", "", phone_number)
@@ -12,44 +19,121 @@ def normalize_mdn(phone_number: str) -> str:
         digits = digits[1:]
     return digits
 
+PHONE_PATTERN = re.compile(r"(?<!\d)(?:\+?1[\s.-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}(?!\d)")
+
+def extract_mdns(text: str) -> list:
+    mdns = []
+    for match in PHONE_PATTERN.findall(text or ""):
+        mdn = normalize_mdn(match)
+        if len(mdn) == 10 and mdn not in mdns:
+            mdns.append(mdn)
+    return mdns
+
+MANAGERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "pond_manager_access.txt")
+
+def read_managers(path: str) -> set:
+    managers = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            clean = normalize_mdn(line.strip())
+            if clean:
+                managers.add(clean)
+    return managers
+
 def load_managers_list(path: str | None = None) -> set:
     if path is None:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.join(base_dir, "resources", "pond_manager_access.txt")
+        path = MANAGERS_FILE
 
     if not os.path.exists(path):
-        print(f"[AUTH] managers file not found: {path}")
+        LOG.warning("managers file not found: %s", path)
         return set()
 
-    managers = set()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                clean = normalize_mdn(line.strip())
-                if clean:
-                    managers.add(clean)
+        managers = read_managers(path)
     except Exception as e:
-        print(f"[AUTH] error loading managers from {path}: {e}")
+        LOG.error("error loading managers from %s: %s", path, e)
         return set()
 
-    print(f"[AUTH] loaded {len(managers)} managers: {managers}")
+    LOG.info("loaded %d managers from %s", len(managers), path)
     return managers
 
-MANAGERS = load_managers_list()
+class ManagerRoster:
+    # Lookups read an immutable frozenset; a watcher thread swaps in a new one when the file changes
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self.mtime = self._mtime()
+        self.managers = frozenset(load_managers_list(path))
+
+    def __contains__(self, mdn: str) -> bool:
+        return mdn in self.managers
+
+    def __len__(self) -> int:
+        return len(self.managers)
+
+    def _mtime(self) -> float | None:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def reload_if_changed(self):
+        mtime = self._mtime()
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        if mtime is None:
+            LOG.warning("managers file removed, roster is now empty: %s", self.path)
+            self.managers = frozenset()
+            return
+        try:
+            managers = frozenset(read_managers(self.path))
+        except Exception as e:
+            LOG.error("keeping %d managers, reload of %s failed: %s", len(self.managers), self.path, e)
+            return
+        self.managers = managers
+        LOG.info("reloaded %d managers from %s", len(managers), self.path)
+
+    def watch(self):
+        def run():
+            while True:
+                time.sleep(self.check_interval)
+                self.reload_if_changed()
+
+        threading.Thread(target=run, name="roster-watch", daemon=True).start()
+
+MANAGERS = ManagerRoster(MANAGERS_FILE, config.ROSTER_CHECK_SECONDS)
+MANAGERS.watch()
+
+LINE_ID_CACHE = TTLCache(config.LINE_ID_CACHE_SIZE, config.LINE_ID_TTL_SECONDS)
+LINE_ID_FLIGHTS = SingleFlight()
 
 def get_line_id(mdn: str):
     clean_mdn = normalize_mdn(mdn)
-    url = f"{API_URL}/lines?by_quick_find[]={clean_mdn}"
-    headers = {
-        "X-AUTH-TOKEN": API_TOKEN,
-        "Content-Type": "application/json"
-    }
 
+    cached = LINE_ID_CACHE.get(clean_mdn)
+    if cached is not MISSING:
+        return cached
+
+    line_id = LINE_ID_FLIGHTS.do(clean_mdn, fetch_line_id, clean_mdn)
+    if line_id is not MISSING:
+        ttl = config.LINE_ID_TTL_SECONDS if line_id else config.LINE_ID_NEGATIVE_TTL_SECONDS
+        LINE_ID_CACHE.set(clean_mdn, line_id, ttl=ttl)
+        return line_id
+
+    # BeQuick unreachable: an expired answer beats reporting the line as unregistered
+    stale = LINE_ID_CACHE.get_stale(clean_mdn)
+    return stale if stale is not MISSING else None
+
+def invalidate_line_id(mdn: str):
+    LINE_ID_CACHE.invalidate(normalize_mdn(mdn))
+
+def fetch_line_id(clean_mdn: str):
     try:
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = bequick.get("get_line_id", f"/lines?by_quick_find[]={clean_mdn}")
         if resp.status_code != 200:
-            print(f"[BeQuick] Error {resp.status_code}: {resp.text}")
-            return None
+            BEQUICK_LOG.warning("line lookup failed", extra={"status": resp.status_code, "body": resp.text[:200]})
+            return MISSING
 
         data = resp.json() or {}
         lines = data.get("lines", [])
@@ -59,12 +143,15 @@ def get_line_id(mdn: str):
         return lines[0].get("id")
 
     except requests.exceptions.RequestException as e:
-        print(f"[BeQuick] Connection error: {e}")
-        return None
+        BEQUICK_LOG.warning("line lookup connection error: %s", e)
+        return MISSING
 
 def is_client(mdn: str) -> bool:
     return get_line_id(mdn) is not None
 
-def is_manager(mdn: str) -> bool:
+def is_manager(mdn: str, line_verified: bool = False) -> bool:
+    # Pass line_verified=True when the caller has just resolved the line itself
     normalized = normalize_mdn(mdn)
-    return normalized in MANAGERS and is_client(normalized)
+    if normalized not in MANAGERS:
+        return False
+    return line_verified or is_client(normalized)
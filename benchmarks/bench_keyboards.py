@@ -0,0 +1,35 @@
+"""Per-message cost of building reply_markup: rebuilt per send vs cached.
+
+Run from the repository root:  python -m benchmarks.bench_keyboards
+"""
+import timeit
+
+from telebot import apihelper
+
+import bot2
+
+N = 20000
+
+KEYBOARDS = [
+    ("kb_main", ()),
+    ("kb_back", ("main_menu",)),
+    ("kb_mgr_usage", ()),
+    ("kb_mgr_refresh", ()),
+    ("kb_share_phone", ()),
+    ("kb_otp_delivery", ("pondotpbot",)),
+]
+
+
+def main():
+    print(f"{'keyboard':<18}{'rebuilt (us)':>14}{'cached (us)':>14}{'saving':>10}")
+    for name, args in KEYBOARDS:
+        cached = getattr(bot2, name)
+        build = cached.__wrapped__
+        # What apihelper does per send_message: build the tree, then to_json()
+        rebuilt = timeit.timeit(lambda: apihelper._convert_markup(build(*args)), number=N) / N * 1e6
+        reused = timeit.timeit(lambda: apihelper._convert_markup(cached(*args)), number=N) / N * 1e6
+        print(f"{name:<18}{rebuilt:>14.2f}{reused:>14.2f}{rebuilt / reused:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""End-to-end load test of bot2.py against local BeQuick and Telegram stand-ins.
+
+Each simulated user walks /start -> Check Usage -> share contact -> OTP ->
+usage result, then Refresh Line -> share contact -> refresh result. Updates
+are fed through bot.process_new_updates exactly as polling would, and every
+step is timed until the bot's reply reaches the fake Telegram server.
+
+Run from the repository root:
+    python -m benchmarks.loadtest --users 200 --concurrency 50 --bequick-latency 150
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+STEPS = ("start", "menu_usage", "contact", "otp_usage", "refresh")
+
+
+class Latency:
+    def __init__(self, mean_ms: float, error_rate: float):
+        self.mean = mean_ms / 1000
+        self.error_rate = error_rate
+
+    def sleep(self):
+        if self.mean:
+            time.sleep(random.uniform(0.5, 1.5) * self.mean)
+
+    def fail(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def serve(handler_cls) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# === Fake BeQuick ===
+def bequick_handler(latency: Latency):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            latency.sleep()
+            if latency.fail():
+                return self.reply(500, {"error": "injected"})
+            url = urlparse(self.path)
+            if url.path == "/lines":
+                mdn = parse_qs(url.query).get("by_quick_find[]", [""])[0]
+                return self.reply(200, {"lines": [{"id": int(mdn)}] if mdn else []})
+            if url.path.endswith("/query_service_details"):
+                usage = {"total": 5242880, "remaining": 3145728, "used_by_this_line": 2097152}
+                return self.reply(200, {"usage_summary": {"international_data": usage}})
+            self.reply(404, {})
+
+        def do_POST(self):
+            latency.sleep()
+            if latency.fail():
+                return self.reply(500, {"error": "injected"})
+            if self.path.endswith("/network_reset"):
+                return self.reply(200, {})
+            self.reply(404, {})
+
+    return Handler
+
+
+# === Fake Telegram Bot API ===
+class Inbox:
+    def __init__(self):
+        self.messages = {}
+        self.cond = threading.Condition()
+
+    def add(self, token: str, chat_id: int, text: str):
+        with self.cond:
+            self.messages.setdefault(chat_id, []).append((token, text))
+            self.cond.notify_all()
+
+    def mark(self, chat_id: int) -> int:
+        with self.cond:
+            return len(self.messages.get(chat_id, []))
+
+    def wait(self, chat_id: int, since: int, token: str, pattern: str, timeout: float) -> str | None:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                for t, text in self.messages.get(chat_id, [])[since:]:
+                    if t == token and re.search(pattern, text):
+                        return text
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+
+def telegram_handler(latency: Latency, inbox: Inbox):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def handle_call(self):
+            url = urlparse(self.path)
+            _, token, method = url.path.split("/", 2)
+            token = token[len("bot"):]
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                params.update({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+            latency.sleep()
+
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": f"bench_{token[:6]}"}
+            elif method == "sendMessage":
+                if latency.fail():
+                    return self.reply({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                       "parameters": {"retry_after": 1}})
+                chat_id = int(params["chat_id"])
+                inbox.add(token, chat_id, params.get("text", ""))
+                result = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+            elif method == "getUpdates":
+                result = []
+            else:
+                result = True
+            self.reply({"ok": True, "result": result})
+
+        def reply(self, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = handle_call
+        do_POST = handle_call
+
+    return Handler
+
+
+# === Simulated users ===
+def message_update(update_id: int, chat_id: int, **fields) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+    }
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}},
+        },
+    }
+
+
+class Driver:
+    def __init__(self, bot2, inbox: Inbox, bot_token: str, otp_token: str, timeout: float, otp_think: float):
+        self.bot2 = bot2
+        self.inbox = inbox
+        self.bot_token = bot_token
+        self.otp_token = otp_token
+        self.timeout = timeout
+        self.otp_think = otp_think
+        self.update_ids = iter(range(1, 10**9))
+        self.lock = threading.Lock()
+        self.timings = {step: [] for step in STEPS}
+        self.failures = {step: 0 for step in STEPS}
+
+    def push(self, build, *args, **kwargs):
+        with self.lock:
+            update_id = next(self.update_ids)
+        update = self.bot2.telebot.types.Update.de_json(build(update_id, *args, **kwargs))
+        self.bot2.bot.process_new_updates([update])
+
+    def step(self, name: str, chat_id: int, action, pattern: str, token: str | None = None) -> str | None:
+        since = self.inbox.mark(chat_id)
+        started = time.perf_counter()
+        action()
+        text = self.inbox.wait(chat_id, since, token or self.bot_token, pattern, self.timeout)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            if text is None:
+                self.failures[name] += 1
+            else:
+                self.timings[name].append(elapsed)
+        return text
+
+    def run_user(self, n: int) -> bool:
+        chat_id = 5550000000 + n
+        phone = f"+1{chat_id}"
+        contact = {"phone_number": phone, "first_name": "bench", "user_id": chat_id}
+
+        if not self.step("start", chat_id, lambda: self.push(message_update, chat_id, text="/start",
+                         entities=[{"type": "bot_command", "offset": 0, "length": 6}]), "."):
+            return False
+        if not self.step("menu_usage", chat_id, lambda: self.push(callback_update, chat_id, "check_usage"), "."):
+            return False
+        code = self.step("contact", chat_id, lambda: self.push(message_update, chat_id, contact=contact),
+                         r"\d{6}", token=self.otp_token)
+        if not code:
+            return False
+        code = re.search(r"\d{6}", code).group(0)
+        # Time spent switching to the OTP chat and typing the code
+        time.sleep(self.otp_think)
+        if not self.step("otp_usage", chat_id, lambda: self.push(message_update, chat_id, text=code), "Used:"):
+            return False
+
+        def refresh():
+            self.push(callback_update, chat_id, "refresh_line")
+            self.push(message_update, chat_id, contact=contact)
+
+        # The queued reply comes first; the step ends with the follow-up outcome
+        return bool(self.step("refresh", chat_id, refresh, "refreshed|Refresh failed|connection error"))
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--bequick-latency", type=float, default=100, help="mean BeQuick latency, ms")
+    parser.add_argument("--bequick-errors", type=float, default=0.0, help="fraction of BeQuick calls answering 500")
+    parser.add_argument("--telegram-latency", type=float, default=30, help="mean Telegram API latency, ms")
+    parser.add_argument("--telegram-errors", type=float, default=0.0, help="fraction of sendMessage calls answering 429")
+    parser.add_argument("--unthrottled", action="store_true", help="lift the outbound send rate limits")
+    parser.add_argument("--timeout", type=float, default=60, help="per-step timeout, s")
+    parser.add_argument("--otp-think", type=float, default=0.0, help="pause before entering the OTP code, s")
+    args = parser.parse_args()
+
+    inbox = Inbox()
+    bequick = serve(bequick_handler(Latency(args.bequick_latency, args.bequick_errors)))
+    telegram = serve(telegram_handler(Latency(args.telegram_latency, args.telegram_errors), inbox))
+
+    bot_token, otp_token = "100:bench-bot", "200:bench-otp"
+    os.environ.update({
+        "BEQUICK_API_URL": f"http://127.0.0.1:{bequick.server_port}",
+        "BEQUICK_TOKEN": "bench",
+        "TELEGRAM_TOKEN": bot_token,
+        "TELEGRAM_OTP_TOKEN": otp_token,
+        "STAT_DIR": tempfile.mkdtemp(prefix="pond-bench-"),
+    })
+    if args.unthrottled:
+        os.environ.update({"SEND_GLOBAL_RATE": "100000", "SEND_CHAT_RATE": "100000", "SEND_CHAT_BURST": "100000"})
+
+    from telebot import apihelper
+    apihelper.API_URL = f"http://127.0.0.1:{telegram.server_port}/bot{{0}}/{{1}}"
+
+    import bot2
+
+    driver = Driver(bot2, inbox, bot_token, otp_token, args.timeout, args.otp_think)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        completed = sum(pool.map(driver.run_user, range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    print(f"users={args.users} concurrency={args.concurrency} bequick={args.bequick_latency}ms "
+          f"errors={args.bequick_errors:.0%} telegram={args.telegram_latency}ms unthrottled={args.unthrottled}")
+    print(f"completed {completed}/{args.users} in {elapsed:.2f}s -> {completed / elapsed:.2f} users/s")
+    print(f"{'step':<12}{'ok':>6}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step in STEPS:
+        values = driver.timings[step]
+        p50, p95, p99 = (percentile(values, q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"{step:<12}{len(values):>6}{driver.failures[step]:>6}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+    return 0 if completed == args.users else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
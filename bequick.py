@@ -0,0 +1,113 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import heartbeat
+import metrics
+from breaker import CircuitBreaker, OPEN
+
+# (connect timeout, read timeout) and number of retries per endpoint.
+# Only failed connects and 502/503/504 are retried, and never past
+# BEQUICK_DEADLINE_SECONDS in total; a read timeout means BeQuick is slow,
+# and asking again would only make the caller wait longer.
+# network_reset is not idempotent, so it is never retried once sent.
+ENDPOINTS = {
+    "get_line_id": {"timeout": (3.05, 10), "retries": 2},
+    "check_usage": {"timeout": (3.05, 10), "retries": 2},
+    "network_reset": {"timeout": (3.05, 10), "retries": 0},
+}
+
+RETRY_STATUSES = (502, 503, 504)
+
+BREAKERS = {
+    endpoint: CircuitBreaker(
+        config.BREAKER_WINDOW_SECONDS,
+        config.BREAKER_MIN_CALLS,
+        config.BREAKER_ERROR_RATE,
+        config.BREAKER_OPEN_SECONDS,
+    )
+    for endpoint in ENDPOINTS
+}
+
+HEADERS = {
+    "X-AUTH-TOKEN": config.secret("BEQUICK"),
+    "Content-Type": "application/json",
+}
+
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+ADAPTER = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=config.BEQUICK_POOL_SIZE,
+    pool_block=False,
+    max_retries=0,
+)
+SESSION.mount("https://", ADAPTER)
+SESSION.mount("http://", ADAPTER)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+def request(method: str, endpoint: str, path: str, **kwargs) -> requests.Response:
+    breaker = BREAKERS[endpoint]
+    if not breaker.allow():
+        metrics.BEQUICK_ERRORS.inc(endpoint, "circuit_open")
+        raise CircuitOpenError(f"BeQuick {endpoint} circuit is open")
+
+    ok = False
+    try:
+        resp = attempt_request(method, endpoint, path, **kwargs)
+        ok = resp.status_code < 500
+        return resp
+    finally:
+        breaker.record(ok)
+
+
+def attempt_request(method: str, endpoint: str, path: str, **kwargs) -> requests.Response:
+    policy = ENDPOINTS[endpoint]
+    attempts = policy["retries"] + 1
+    connect_timeout, read_timeout = policy["timeout"]
+    url = f"{config.API_URL}{path}"
+    deadline = time.monotonic() + config.BEQUICK_DEADLINE_SECONDS
+
+    for attempt in range(attempts):
+        backoff = config.BEQUICK_RETRY_BACKOFF * (2 ** attempt)
+        remaining = deadline - time.monotonic()
+        timeout = (max(0.5, min(connect_timeout, remaining)), max(0.5, min(read_timeout, remaining)))
+        started = time.perf_counter()
+        try:
+            resp = SESSION.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.BEQUICK_SECONDS.observe(time.perf_counter() - started, endpoint)
+            read_timed_out = isinstance(e, requests.exceptions.ReadTimeout)
+            metrics.BEQUICK_ERRORS.inc(endpoint, "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection")
+            heartbeat.mark("last_bequick_error")
+            if read_timed_out or attempt == attempts - 1 or time.monotonic() + backoff >= deadline:
+                raise
+        else:
+            metrics.BEQUICK_SECONDS.observe(time.perf_counter() - started, endpoint)
+            if resp.status_code != 200:
+                metrics.BEQUICK_ERRORS.inc(endpoint, f"http_{resp.status_code}")
+            heartbeat.mark("last_bequick_error" if resp.status_code >= 500 else "last_bequick_ok")
+            if (resp.status_code not in RETRY_STATUSES or attempt == attempts - 1
+                    or time.monotonic() + backoff >= deadline):
+                return resp
+            resp.close()
+        time.sleep(backoff)
+
+
+def get(endpoint: str, path: str, **kwargs) -> requests.Response:
+    return request("GET", endpoint, path, **kwargs)
+
+
+def post(endpoint: str, path: str, **kwargs) -> requests.Response:
+    return request("POST", endpoint, path, **kwargs)
+
+
+metrics.Gauge(
+    "bequick_circuit_open", "1 while the endpoint's circuit breaker is open", ("endpoint",),
+    fn=lambda: {(endpoint,): int(b.state == OPEN) for endpoint, b in BREAKERS.items()},
+)
@@ -1,70 +1,87 @@
+import startup
+
 import time
+import socket
+import functools
+import threading
+import concurrent.futures
 import requests
 import telebot
 from telebot import apihelper
-from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
 import auth
+import config
 import features
 import utils
 import otp
-
-telegram_token = utils.load_token("TELEGRAM")
-telegram_otp_token = utils.load_token("TELEGRAM_OTP")
-
-bot = telebot.TeleBot(telegram_token)
-otp_bot = telebot.TeleBot(telegram_otp_token)
-
-user_mdns = {}
-user_actions = {}
-manager_state = {}
-post_otp_action = {}
-verified_until = {}
-otp_bot_allowed = set()
+import stats
+import sessions
+import webhook
+import heartbeat
+import log
+import metrics
+import snapshot
+from dispatcher import ShardedDispatcher
+from outbox import Outbox
+
+startup.mark("imports")
+
+# Handlers run on the dispatcher lanes, not on telebot's own worker pool
+bot = telebot.TeleBot(config.secret("TELEGRAM"), threaded=False)
+otp_bot = telebot.TeleBot(config.secret("TELEGRAM_OTP"))
 
 VERIFIED_TTL_SECONDS = 120
+OTP_THROTTLED_TEXT = "Too many verification codes were requested. Please try again later."
+OTP_SENT_TEXT = f"The verification code was sent in the OTP chat. Enter it here within {config.OTP_TTL_SECONDS:g} seconds."
 
 SESSION = requests.Session()
-RETRY = Retry(
-    total=5,
-    connect=5,
-    read=5,
-    backoff_factor=0.7,
-    status_forcelist=(429, 500, 502, 503, 504),
-    allowed_methods=("GET", "POST"),
-    raise_on_status=False,
-)
-ADAPTER = HTTPAdapter(max_retries=RETRY)
+# No transport-level retries: the outbox retries sends without holding a
+# worker, and polling and getMe run in their own retry loops
+ADAPTER = HTTPAdapter(max_retries=0)
 SESSION.mount("https://", ADAPTER)
 SESSION.mount("http://", ADAPTER)
 apihelper._get_req_session = lambda: SESSION
 
 
-def send(tb: telebot.TeleBot, chat_id: int, text: str, **kwargs) -> bool:
-    for _ in range(5):
-        try:
-            tb.send_message(chat_id, text, **kwargs)
-            return True
-        except Exception:
-            time.sleep(0.8)
-    return False
+OUTBOXES = {
+    bot: Outbox(bot, "bot"),
+    otp_bot: Outbox(otp_bot, "otp_bot"),
+}
+
+startup.mark("telegram clients")
+
+
+def send(tb: telebot.TeleBot, chat_id: int, text: str, wait: bool = False, **kwargs) -> bool:
+    future = OUTBOXES[tb].submit(chat_id, text, **kwargs)
+    if future is None:
+        return False
+    if not wait:
+        return True
+    try:
+        return future.result(timeout=config.SEND_WAIT_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        return False
 
 
 def now() -> float:
     return time.time()
 
 
+def session(chat_id: int) -> sessions.Session:
+    return sessions.STORE.get(chat_id)
+
+
 def is_verified(chat_id: int) -> bool:
-    exp = verified_until.get(chat_id, 0)
-    if exp and now() < exp:
+    s = session(chat_id)
+    if s.verified_until and now() < s.verified_until:
         return True
-    verified_until.pop(chat_id, None)
+    s.verified_until = 0.0
     return False
 
 
 def set_verified(chat_id: int):
-    verified_until[chat_id] = now() + VERIFIED_TTL_SECONDS
+    session(chat_id).verified_until = now() + VERIFIED_TTL_SECONDS
 
 
 def get_otp_bot_username() -> str | None:
@@ -77,17 +94,43 @@ def get_otp_bot_username() -> str | None:
     return None
 
 
-OTP_BOT_USERNAME = get_otp_bot_username()
+# Resolved in the background at startup; until then the OTP keyboard
+# simply has no "Open OTP chat" link.
+OTP_BOT_USERNAME = None
+
+
+def resolve_otp_bot_username():
+    global OTP_BOT_USERNAME
+    OTP_BOT_USERNAME = get_otp_bot_username()
+    startup.LOG.info("OTP bot username: %s", OTP_BOT_USERNAME or "unavailable")
+
+
+def cached_markup(build):
+    # Keyboards are static, so each one is built and serialized once and the
+    # JSON string is passed as reply_markup (telebot sends strings as-is).
+    cache = {}
+
+    @functools.wraps(build)
+    def wrapper(*args):
+        markup = cache.get(args)
+        if markup is None:
+            markup = build(*args).to_json()
+            cache[args] = markup
+        return markup
 
+    return wrapper
 
-def kb_otp_delivery():
+
+@cached_markup
+def kb_otp_delivery(username: str | None):
     kb = telebot.types.InlineKeyboardMarkup(row_width=1)
-    if OTP_BOT_USERNAME:
-        kb.add(telebot.types.InlineKeyboardButton("Open OTP chat", url=f"https://t.me/{OTP_BOT_USERNAME}"))
+    if username:
+        kb.add(telebot.types.InlineKeyboardButton("Open OTP chat", url=f"https://t.me/{username}"))
     kb.add(telebot.types.InlineKeyboardButton("Retry sending code", callback_data="otp_retry"))
     return kb
 
 
+@cached_markup
 def kb_main():
     kb = telebot.types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -102,6 +145,7 @@ def kb_main():
     return kb
 
 
+@cached_markup
 def kb_back(prev=None):
     kb = telebot.types.InlineKeyboardMarkup()
     if prev:
@@ -110,6 +154,7 @@ def kb_back(prev=None):
     return kb
 
 
+@cached_markup
 def kb_mgr_usage():
     kb = telebot.types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -120,6 +165,7 @@ def kb_mgr_usage():
     return kb
 
 
+@cached_markup
 def kb_mgr_refresh():
     kb = telebot.types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -130,12 +176,32 @@ def kb_mgr_refresh():
     return kb
 
 
+@cached_markup
 def kb_share_phone():
     kb = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     kb.add(telebot.types.KeyboardButton("📱 Share my phone", request_contact=True))
     return kb
 
 
+@cached_markup
+def kb_bulk_pages(page: int, total: int):
+    kb = telebot.types.InlineKeyboardMarkup(row_width=2)
+    nav = []
+    if page > 1:
+        nav.append(telebot.types.InlineKeyboardButton("◀️ Prev", callback_data=f"bulk_page:{page - 1}"))
+    if page < total:
+        nav.append(telebot.types.InlineKeyboardButton("Next ▶️", callback_data=f"bulk_page:{page + 1}"))
+    if nav:
+        kb.add(*nav)
+    kb.add(telebot.types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
+    return kb
+
+
+@cached_markup
+def kb_remove():
+    return telebot.types.ReplyKeyboardRemove()
+
+
 def welcome(chat_id: int):
     content = utils.load_prompt("welcome")
     if not content.strip():
@@ -148,9 +214,9 @@ def ask_phone(chat_id: int, prompt_name: str):
 
 
 def otp_send(chat_id: int, code: str) -> bool:
-    ok = send(otp_bot, chat_id, f"🔐 {code}")
+    ok = send(otp_bot, chat_id, f"🔐 {code}", wait=True)
     if ok:
-        otp_bot_allowed.add(chat_id)
+        session(chat_id).otp_bot_allowed = True
     return ok
 
 
@@ -159,12 +225,53 @@ def request_otp_delivery(chat_id: int):
         bot,
         chat_id,
         "Open the OTP chat to enable delivery, then tap Retry.",
-        reply_markup=kb_otp_delivery(),
+        reply_markup=kb_otp_delivery(OTP_BOT_USERNAME),
     )
 
 
+# Usage lookups started when the phone is shared, keyed by chat_id. They are
+# process-local and only handed to run_action once the OTP checks out.
+PREFETCHES = {}
+
+
+def start_prefetch(chat_id: int, mdn: str):
+    discard_prefetch(PREFETCHES.pop(chat_id, (None, None))[1])
+    future = features.prefetch_usage(mdn)
+    PREFETCHES[chat_id] = (mdn, future)
+    metrics.PREFETCH_EVENTS.inc("started")
+    # Outlives a retried code; anything older is not worth showing
+    sessions.SWEEPER.schedule(2 * config.OTP_TTL_SECONDS, drop_prefetch, chat_id, future)
+
+
+def take_prefetch(chat_id: int, mdn: str):
+    entry = PREFETCHES.pop(chat_id, None)
+    if not entry:
+        return None
+    if entry[0] != mdn:
+        discard_prefetch(entry[1])
+        return None
+    return entry[1]
+
+
+def drop_prefetch(chat_id: int, future=None):
+    entry = PREFETCHES.get(chat_id)
+    if entry and (future is None or entry[1] is future):
+        PREFETCHES.pop(chat_id, None)
+        discard_prefetch(entry[1])
+
+
+def discard_prefetch(future):
+    # A lookup that has not started yet never reaches BeQuick
+    if future is None:
+        return
+    future.cancel()
+    metrics.PREFETCH_EVENTS.inc("discarded")
+
+
 def run_action(chat_id: int, mdn: str):
-    action = post_otp_action.pop(chat_id, None)
+    s = session(chat_id)
+    action, s.post_otp_action = s.post_otp_action, None
+    prefetched = take_prefetch(chat_id, mdn)
     if not action:
         welcome(chat_id)
         return
@@ -174,14 +281,17 @@ def run_action(chat_id: int, mdn: str):
     actions = {
         "manager_menu_usage": lambda: send(bot, chat_id, utils.load_prompt("manager_access"), reply_markup=kb_mgr_usage()),
         "manager_menu_refresh": lambda: send(bot, chat_id, utils.load_prompt("manager_access"), reply_markup=kb_mgr_refresh()),
-        "regular_usage": lambda: do_usage(chat_id, mdn),
+        "regular_usage": lambda: do_usage(chat_id, mdn, prefetched),
         "regular_refresh": lambda: do_refresh(chat_id, mdn),
         "manager_usage_self": lambda: do_usage(chat_id, mdn),
         "manager_refresh_self": lambda: do_refresh(chat_id, mdn),
-        "manager_usage_other": lambda: (manager_state.__setitem__(chat_id, "usage_other"), send(bot, chat_id, utils.load_prompt("manager_enter_other_usage"))),
-        "manager_refresh_other": lambda: (manager_state.__setitem__(chat_id, "refresh_other"), send(bot, chat_id, utils.load_prompt("manager_enter_other_refresh"))),
+        "manager_usage_other": lambda: (setattr(s, "manager_state", "usage_other"), send(bot, chat_id, enter_other_prompt("usage"))),
+        "manager_refresh_other": lambda: (setattr(s, "manager_state", "refresh_other"), send(bot, chat_id, enter_other_prompt("refresh"))),
     }
 
+    if t != "regular_usage":
+        discard_prefetch(prefetched)
+
     fn = actions.get(t)
     if fn:
         fn()
@@ -189,35 +299,59 @@ def run_action(chat_id: int, mdn: str):
         welcome(chat_id)
 
 
+def enter_other_prompt(kind: str) -> str:
+    return utils.load_prompt(f"manager_enter_other_{kind}").format(max_numbers=config.BULK_MAX_NUMBERS)
+
+
 def require_otp(chat_id: int, mdn: str | None, action: dict):
     if not mdn:
         send(bot, chat_id, utils.load_prompt("not_registered"))
         welcome(chat_id)
         return
 
+    session(chat_id).post_otp_action = action
+
     if is_verified(chat_id):
-        post_otp_action[chat_id] = action
         run_action(chat_id, mdn)
         return
 
-    post_otp_action[chat_id] = action
     code = otp.start(chat_id, mdn)
+    if not code:
+        send(bot, chat_id, OTP_THROTTLED_TEXT, reply_markup=kb_main())
+        return
+
+    # Only once a code was actually issued, so the OTP limits also cap prefetches
+    if action.get("type") == "regular_usage":
+        start_prefetch(chat_id, mdn)
 
     if otp_send(chat_id, code):
-        send(bot, chat_id, "The verification code was sent in the OTP chat. Enter it here within 60 seconds.")
+        send(bot, chat_id, OTP_SENT_TEXT)
         return
 
     request_otp_delivery(chat_id)
 
 
-def do_usage(chat_id: int, mdn: str):
-    line_id = auth.get_line_id(mdn)
-    if not line_id:
+def do_usage(chat_id: int, mdn: str, prefetched=None):
+    ready = prefetched is not None and prefetched.done()
+    if prefetched is not None and not ready and prefetched.cancel():
+        # Still waiting for a prefetch worker: fetching inline is quicker
+        metrics.PREFETCH_EVENTS.inc("unstarted")
+        prefetched = None
+    if not ready:
+        if not auth.get_line_id(mdn):
+            send(bot, chat_id, utils.load_prompt("not_registered"))
+            welcome(chat_id)
+            return
+        send(bot, chat_id, utils.load_prompt("usage_checking_wait"))
+    if prefetched is not None:
+        metrics.PREFETCH_EVENTS.inc("ready" if ready else "pending")
+        _, usage = prefetched.result()
+    else:
+        usage = features.check_usage(auth.get_line_id(mdn))
+    if usage is None:
         send(bot, chat_id, utils.load_prompt("not_registered"))
         welcome(chat_id)
         return
-    send(bot, chat_id, utils.load_prompt("usage_checking_wait"))
-    usage = features.check_usage(line_id)
     send(
         bot,
         chat_id,
@@ -229,19 +363,78 @@ def do_usage(chat_id: int, mdn: str):
 
 
 def do_refresh(chat_id: int, mdn: str):
-    msg = features.handle_refresh_request(mdn)
-    send(bot, chat_id, msg, reply_markup=kb_back("main_menu"), disable_web_page_preview=True)
+    features.handle_refresh_request(
+        mdn, chat_id,
+        lambda msg: send(bot, chat_id, msg, reply_markup=kb_back("main_menu"), disable_web_page_preview=True),
+    )
+
+
+def notify_refresh(chat_id: int, mdn: str, result: str):
+    text = features.refresh_result_text(result)
+    send(bot, chat_id, text, reply_markup=kb_back("main_menu"), disable_web_page_preview=True)
+
+
+def notify_bulk_refresh(chat_id: int, items: list):
+    lines = [features.bulk_refresh_result_line(mdn, result) for mdn, result in items]
+    header = utils.load_prompt("bulk_refresh_results_header").format(count=len(lines))
+    show_bulk_pages(chat_id, features.paginate(header, lines, config.BULK_PAGE_SIZE))
+
+
+features.REFRESH_JOBS.notify = notify_refresh
+features.REFRESH_JOBS.notify_batch = notify_bulk_refresh
+
+
+CALLBACK_LABELS = {
+    "main_menu", "otp_retry", "check_usage", "refresh_line", "support", "sales",
+    "manager_usage_self", "manager_refresh_self", "manager_usage_other", "manager_refresh_other",
+    "bulk_page",
+}
+
+
+def callback_label(call) -> str:
+    name = (call.data or "").split(":", 1)[0]
+    return name if name in CALLBACK_LABELS else "other"
+
+
+def do_bulk(chat_id: int, kind: str, mdns: list):
+    skipped = len(mdns) - config.BULK_MAX_NUMBERS
+    mdns = mdns[:config.BULK_MAX_NUMBERS]
+    send(bot, chat_id, utils.load_prompt("bulk_processing").format(count=len(mdns)))
+    # The lookups run on the bulk pool, so this lane goes straight back to other chats
+    features.bulk_report(kind, mdns, chat_id, functools.partial(finish_bulk, chat_id, kind, len(mdns), skipped))
+
+
+def finish_bulk(chat_id: int, kind: str, count: int, skipped: int, lines: list):
+    if skipped > 0:
+        lines.append(utils.load_prompt("bulk_skipped").format(skipped=skipped, max_numbers=config.BULK_MAX_NUMBERS))
+    header = utils.load_prompt(f"bulk_{kind}_header").format(count=count)
+    show_bulk_pages(chat_id, features.paginate(header, lines, config.BULK_PAGE_SIZE))
+
+
+def show_bulk_pages(chat_id: int, pages: list):
+    # Off the chat's lane, so the session is taken the way an update takes it
+    with sessions.STORE.batch(chat_id):
+        session(chat_id).bulk_pages = pages
+        send_bulk_page(chat_id, 1)
+
+
+def send_bulk_page(chat_id: int, page: int):
+    pages = session(chat_id).bulk_pages
+    if not pages or not 1 <= page <= len(pages):
+        send(bot, chat_id, "These results are no longer available.", reply_markup=kb_main())
+        return
+    send(bot, chat_id, pages[page - 1], reply_markup=kb_bulk_pages(page, len(pages)), disable_web_page_preview=True)
 
 
 @bot.message_handler(commands=["start"])
+@metrics.timed(metrics.HANDLER_SECONDS, lambda message: "start")
 def on_start(message):
-    stat = utils.load_stat()
-    stat["visitors"] += 1
-    utils.save_stat(stat)
+    stats.increment_visitors()
     welcome(message.chat.id)
 
 
 @bot.callback_query_handler(func=lambda call: True)
+@metrics.timed(metrics.HANDLER_SECONDS, callback_label)
 def on_callback(call):
     chat_id = call.message.chat.id
     data = call.data
@@ -254,39 +447,44 @@ def on_callback(call):
         if not otp.is_waiting(chat_id):
             send(bot, chat_id, "No active verification. Please try again from the main menu.", reply_markup=kb_main())
             return
-        code = otp.peek_code(chat_id)
+        code = otp.reissue(chat_id)
         if not code:
-            send(bot, chat_id, "The verification code expired. Please try again.", reply_markup=kb_main())
+            send(bot, chat_id, OTP_THROTTLED_TEXT, reply_markup=kb_main())
             return
         if otp_send(chat_id, code):
-            send(bot, chat_id, "The verification code was sent in the OTP chat. Enter it here within 60 seconds.")
+            send(bot, chat_id, OTP_SENT_TEXT)
             return
         request_otp_delivery(chat_id)
         return
 
+    if data.startswith("bulk_page:"):
+        page = data.split(":", 1)[1]
+        send_bulk_page(chat_id, int(page) if page.isdigit() else 0)
+        return
+
     if data == "check_usage":
-        utils.increment_button("usage")
-        user_actions[chat_id] = "usage"
+        stats.increment_button("usage")
+        session(chat_id).action = "usage"
         ask_phone(chat_id, "share_phone_usage")
         return
 
     if data == "refresh_line":
-        utils.increment_button("refresh")
-        user_actions[chat_id] = "refresh"
+        stats.increment_button("refresh")
+        session(chat_id).action = "refresh"
         ask_phone(chat_id, "share_phone_refresh")
         return
 
     if data == "support":
-        utils.increment_button("support")
+        stats.increment_button("support")
         send(bot, chat_id, utils.load_prompt("support"), reply_markup=kb_back("main_menu"))
         return
 
     if data == "sales":
-        utils.increment_button("sales")
+        stats.increment_button("sales")
         send(bot, chat_id, utils.load_prompt("sales"), reply_markup=kb_back("main_menu"))
         return
 
-    mdn = user_mdns.get(chat_id)
+    mdn = session(chat_id).mdn
 
     protected = {
         "manager_usage_self": {"type": "manager_usage_self"},
@@ -302,6 +500,7 @@ def on_callback(call):
 
 
 @bot.message_handler(content_types=["contact"])
+@metrics.timed(metrics.HANDLER_SECONDS, lambda message: "contact")
 def on_contact(message):
     chat_id = message.chat.id
 
@@ -315,28 +514,29 @@ def on_contact(message):
         return
 
     mdn = auth.normalize_mdn(c.phone_number)
-    user_mdns[chat_id] = mdn
+    s = session(chat_id)
+    s.mdn = mdn
 
-    send(bot, chat_id, utils.load_prompt("verifying_account"), reply_markup=telebot.types.ReplyKeyboardRemove())
+    send(bot, chat_id, utils.load_prompt("verifying_account"), reply_markup=kb_remove())
 
     if not auth.get_line_id(mdn):
         send(bot, chat_id, utils.load_prompt("not_registered"))
         welcome(chat_id)
-        user_actions.pop(chat_id, None)
+        s.action = None
         return
 
-    action = user_actions.get(chat_id, "usage")
+    action = s.action or "usage"
+    s.action = None
 
-    if auth.is_manager(mdn):
+    if auth.is_manager(mdn, line_verified=True):
         require_otp(chat_id, mdn, {"type": "manager_menu_refresh" if action == "refresh" else "manager_menu_usage"})
-        user_actions.pop(chat_id, None)
         return
 
     require_otp(chat_id, mdn, {"type": "regular_refresh" if action == "refresh" else "regular_usage"})
-    user_actions.pop(chat_id, None)
 
 
 @bot.message_handler(content_types=["text"])
+@metrics.timed(metrics.HANDLER_SECONDS, lambda message: "text")
 def on_text(message):
     chat_id = message.chat.id
     text = (message.text or "").strip()
@@ -349,6 +549,7 @@ def on_text(message):
             run_action(chat_id, mdn)
             return
         if r in ("EXPIRED", "LOCKED"):
+            drop_prefetch(chat_id)
             send(bot, chat_id, "The verification code is no longer valid.")
             return
         if r == "WRONG":
@@ -356,30 +557,147 @@ def on_text(message):
             return
         return
 
-    state = manager_state.get(chat_id)
-
-    if state == "usage_other":
-        manager_state.pop(chat_id, None)
-        target = auth.normalize_mdn(text)
-        do_usage(chat_id, target)
+    s = session(chat_id)
+    state = s.manager_state
+
+    if state in ("usage_other", "refresh_other"):
+        s.manager_state = None
+        kind = "usage" if state == "usage_other" else "refresh"
+        targets = auth.extract_mdns(text)
+        if len(targets) > 1:
+            do_bulk(chat_id, kind, targets)
+        elif kind == "usage":
+            do_usage(chat_id, auth.normalize_mdn(text))
+        else:
+            do_refresh(chat_id, auth.normalize_mdn(text))
         return
 
-    if state == "refresh_other":
-        manager_state.pop(chat_id, None)
-        target = auth.normalize_mdn(text)
-        do_refresh(chat_id, target)
+    send(bot, chat_id, utils.load_prompt("block_text_warning"), reply_markup=kb_main())
+
+
+DISPATCHER = ShardedDispatcher(config.DISPATCH_LANES, config.DISPATCH_LANE_QUEUE_SIZE)
+process_updates = bot.process_new_updates
+
+
+def update_chat_id(update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    return update.update_id
+
+
+def dispatch_updates(updates):
+    # Polling calls this after every getUpdates round, even an empty one
+    heartbeat.mark("last_poll")
+    if not updates:
         return
+    heartbeat.mark("last_received")
+    # Advance the polling offset before the lanes run, so handlers never race on it
+    bot.last_update_id = max(bot.last_update_id, max(u.update_id for u in updates))
+    for update in updates:
+        DISPATCHER.submit(update_chat_id(update), handle_update, update)
 
-    send(bot, chat_id, utils.load_prompt("block_text_warning"), reply_markup=kb_main())
+
+def handle_update(update):
+    try:
+        with sessions.STORE.batch(update_chat_id(update)):
+            process_updates([update])
+    finally:
+        heartbeat.mark("last_update")
+
+
+bot.process_new_updates = dispatch_updates
+
+metrics.Gauge(
+    "dispatch_lane_depth", "Updates waiting per dispatcher lane", ("lane",),
+    fn=lambda: {(str(i),): depth for i, depth in enumerate(DISPATCHER.depths())},
+)
+metrics.Gauge(
+    "send_queue_depth", "Messages waiting in the outbound queue", ("bot",),
+    fn=lambda: {(o.name,): o.depth() for o in OUTBOXES.values()},
+)
+metrics.Gauge(
+    "send_messages", "Outbound queue counters", ("bot", "outcome"),
+    fn=lambda: {(o.name, k): v for o in OUTBOXES.values() for k, v in o.stats.items()},
+)
+metrics.Gauge("sessions", "Live chat sessions", fn=lambda: {(): len(sessions.STORE)})
+metrics.Gauge(
+    "refresh_jobs", "Line refresh job queue counters", ("outcome",),
+    fn=lambda: {(k,): v for k, v in {**features.REFRESH_JOBS.stats, "pending": features.REFRESH_JOBS.depth()}.items()},
+)
+metrics.Gauge("log_records", "Log records queued, dropped or sampled out", ("outcome",), fn=lambda: {(k,): v for k, v in log.stats.items()})
+metrics.Gauge(
+    "line_id_cache", "MDN to line_id cache and single-flight counters", ("event",),
+    fn=lambda: {(k,): v for k, v in {**auth.LINE_ID_CACHE.stats(), **auth.LINE_ID_FLIGHTS.stats()}.items()},
+)
+metrics.Gauge(
+    "usage_cache", "Usage result cache and single-flight counters", ("event",),
+    fn=lambda: {(k,): v for k, v in {**features.USAGE_CACHE.stats(), **features.USAGE_FLIGHTS.stats()}.items()},
+)
+
+
+startup.mark("handlers")
+
+
+def start_services(mode: str):
+    snapshot.start()
+    startup.mark("snapshot")
+    heartbeat.start(mode)
+    metrics.start_export()
+    threading.Thread(target=resolve_otp_bot_username, daemon=True).start()
+    features.REFRESH_JOBS.start()
+    startup.mark("services")
+    startup.report()
 
 
 def run_polling():
+    start_services("polling")
     while True:
         try:
+            # getUpdates is refused while a webhook is registered
+            bot.remove_webhook()
             bot.infinity_polling(skip_pending=True, timeout=30, long_polling_timeout=30)
         except Exception:
             time.sleep(2.0)
 
 
+def process_update(payload: dict):
+    bot.process_new_updates([telebot.types.Update.de_json(payload)])
+
+
+def run_webhook():
+    import uvicorn
+    import api
+
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+        raise ValueError("[ERROR] WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode")
+
+    webhook.start(process_update)
+    start_services("webhook")
+    url = config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH
+    # Only a fresh registration skips the backlog; another worker starting
+    # against the same webhook must not throw away updates still queued for it
+    try:
+        registered = bot.get_webhook_info().url == url
+    except Exception:
+        registered = True
+    bot.set_webhook(url=url, secret_token=config.WEBHOOK_SECRET, drop_pending_updates=not registered)
+    server = uvicorn.Server(uvicorn.Config(api.app, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT))
+    if not config.WEBHOOK_REUSE_PORT:
+        server.run()
+        return
+    # Several worker processes bind the same port and the kernel spreads connections over them
+    sock = socket.socket(socket.AF_INET6 if ":" in config.WEBHOOK_HOST else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((config.WEBHOOK_HOST, config.WEBHOOK_PORT))
+    server.run(sockets=[sock])
+
+
 if __name__ == "__main__":
-    run_polling()
+    if config.BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,62 @@
+import time
+import threading
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, window: float, min_calls: int, error_rate: float, open_seconds: float):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self._calls = deque()
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            # Half-open: let a single probe through to test recovery
+            self.state = HALF_OPEN
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                return
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if ok:
+                    self._reset(CLOSED)
+                else:
+                    self._reset(OPEN, now)
+                return
+
+            self._calls.append((now, ok))
+            if not ok:
+                self._failures += 1
+            while self._calls and self._calls[0][0] < now - self.window:
+                if not self._calls.popleft()[1]:
+                    self._failures -= 1
+            if len(self._calls) >= self.min_calls and self._failures / len(self._calls) >= self.error_rate:
+                self._reset(OPEN, now)
+
+    def _reset(self, state: str, now: float = 0.0):
+        self.state = state
+        self.opened_at = now
+        self._calls.clear()
+        self._failures = 0
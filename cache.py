@@ -0,0 +1,72 @@
+import time
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        # Expired entries stay until LRU eviction so get_stale can still serve them
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key, default=MISSING):
+        entry = self._data.get(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def dump(self) -> list:
+        # (key, value, seconds left); negative for expired entries still kept for get_stale
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value, expires_at - now) for key, (value, expires_at) in self._data.items()]
+
+    def load(self, items: list, elapsed: float = 0.0):
+        now = time.monotonic()
+        with self._lock:
+            for key, value, remaining in items:
+                self._data[key] = (value, now + remaining - elapsed)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
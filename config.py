@@ -1,7 +1,161 @@
-from utils import load_token
+import os
+import pathlib
+import functools
+from dotenv import dotenv_values
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent
+SECRETS_DIR = BASE_DIR / "secrets" / "pondsupportbot2"
+
+
+# Secrets are read on first use and only once per process, so modules that
+# never talk to BeQuick or Telegram (api.py) do not need the files at all.
+@functools.cache
+def secret(name: str) -> str:
+    key = f"{name.upper()}_TOKEN"
+    token = os.getenv(key)
+    if token:
+        return token
+
+    candidates = [
+        SECRETS_DIR / f"{name}.env",
+        SECRETS_DIR / f"{name.lower()}.env",
+        SECRETS_DIR / f"{name.upper()}.env",
+    ]
+    dotenv_path = next((p for p in candidates if p.exists()), None)
+    if not dotenv_path:
+        raise FileNotFoundError(f"[ERROR] Env file not found: tried {[str(p) for p in candidates]}")
+
+    token = dotenv_values(dotenv_path).get(key)
+    if not token:
+        raise ValueError(f"[ERROR] {key} not found in {dotenv_path}")
+    return token
+
 
 # Base BeQuick API URL
-API_URL = "https://pondmobile-atom-api.bequickapps.com"
+API_URL = os.getenv("BEQUICK_API_URL", "https://pondmobile-atom-api.bequickapps.com")
+
+# BeQuick HTTP client: keep-alive pool shared by every handler thread
+BEQUICK_POOL_SIZE = int(os.getenv("BEQUICK_POOL_SIZE", "20"))
+BEQUICK_RETRY_BACKOFF = float(os.getenv("BEQUICK_RETRY_BACKOFF", "0.5"))
+# Upper bound on one call including its retries, so handlers never wait longer than baseline did
+BEQUICK_DEADLINE_SECONDS = float(os.getenv("BEQUICK_DEADLINE_SECONDS", "10"))
+
+# How often resources/pond_manager_access.txt is checked for changes
+ROSTER_CHECK_SECONDS = float(os.getenv("ROSTER_CHECK_SECONDS", "5"))
+
+# How often a template's mtime is re-checked while it is being served
+TEMPLATE_CHECK_SECONDS = float(os.getenv("TEMPLATE_CHECK_SECONDS", "2"))
+
+# MDN -> line_id cache; "not registered" answers are kept for a shorter time
+LINE_ID_CACHE_SIZE = int(os.getenv("LINE_ID_CACHE_SIZE", "10000"))
+LINE_ID_TTL_SECONDS = float(os.getenv("LINE_ID_TTL_SECONDS", "900"))
+LINE_ID_NEGATIVE_TTL_SECONDS = float(os.getenv("LINE_ID_NEGATIVE_TTL_SECONDS", "60"))
+
+# Runtime data: stat.db, heartbeat, metrics export
+STAT_DIR = pathlib.Path(os.getenv("STAT_DIR", str(BASE_DIR / "stat")))
+
+# Usage statistics: counters are kept in memory and flushed to SQLite
+STAT_FLUSH_INTERVAL_SECONDS = float(os.getenv("STAT_FLUSH_INTERVAL_SECONDS", "5"))
+STAT_FLUSH_THRESHOLD = int(os.getenv("STAT_FLUSH_THRESHOLD", "100"))
+# Minute buckets are pruned after this long; hour buckets are kept
+STAT_MINUTE_RETENTION_SECONDS = float(os.getenv("STAT_MINUTE_RETENTION_SECONDS", str(48 * 3600)))
+STAT_CACHE_SECONDS = float(os.getenv("STAT_CACHE_SECONDS", "5"))
+
+# Update ingestion: "polling" (default) or "webhook". In webhook mode bot2.py
+# serves the FastAPI app from api.py and Telegram posts updates to
+# WEBHOOK_URL + WEBHOOK_PATH with WEBHOOK_SECRET as its secret token.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT", "0") == "1"
+
+# Handler dispatch: updates are hashed by chat_id onto worker lanes, so one
+# chat is handled in order while different chats run in parallel
+DISPATCH_LANES = int(os.getenv("DISPATCH_LANES", "8"))
+DISPATCH_LANE_QUEUE_SIZE = int(os.getenv("DISPATCH_LANE_QUEUE_SIZE", "100"))
+
+# Outbound Telegram messages: sent from per-bot worker threads, paced by a
+# global token bucket and a per-chat bucket, honoring 429 retry_after
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "1000"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_WAIT_TIMEOUT_SECONDS = float(os.getenv("SEND_WAIT_TIMEOUT_SECONDS", "15"))
+
+# Per-chat session records: capped in size and dropped after being idle
+SESSION_MAX = int(os.getenv("SESSION_MAX", "50000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+
+# OTP codes: lifetime, wrong guesses allowed, and issuance limits as codes per window (seconds)
+OTP_TTL_SECONDS = float(os.getenv("OTP_TTL_SECONDS", "60"))
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "3"))
+OTP_CHAT_LIMIT = int(os.getenv("OTP_CHAT_LIMIT", "3"))
+OTP_CHAT_WINDOW_SECONDS = float(os.getenv("OTP_CHAT_WINDOW_SECONDS", "600"))
+OTP_MDN_LIMIT = int(os.getenv("OTP_MDN_LIMIT", "5"))
+OTP_MDN_WINDOW_SECONDS = float(os.getenv("OTP_MDN_WINDOW_SECONDS", "3600"))
+
+# Where sessions and OTP state live: "memory" (single process) or "sqlite",
+# a WAL database that several bot processes on one host can share. With
+# sqlite, an update holds its chat's lease for at most SESSION_LEASE_SECONDS.
+# Several processes only make sense in webhook mode (Telegram serves
+# getUpdates to one poller): give each its own WEBHOOK_PORT behind the proxy,
+# or set WEBHOOK_REUSE_PORT=1 to let them all bind one port (Linux).
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DB = pathlib.Path(os.getenv("STATE_DB", str(STAT_DIR / "state.db")))
+SESSION_LEASE_SECONDS = float(os.getenv("SESSION_LEASE_SECONDS", "30"))
+
+# Liveness heartbeat shared with /health through a small mmap'd file
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "5"))
+HEARTBEAT_STALE_SECONDS = float(os.getenv("HEARTBEAT_STALE_SECONDS", "30"))
+POLL_STALE_SECONDS = float(os.getenv("POLL_STALE_SECONDS", "120"))
+UPDATE_STALE_SECONDS = float(os.getenv("UPDATE_STALE_SECONDS", "60"))
+BEQUICK_ERROR_WINDOW_SECONDS = float(os.getenv("BEQUICK_ERROR_WINDOW_SECONDS", "300"))
+
+# Prometheus metrics: the bot process writes its registry to a file that
+# /metrics serves when the API runs in a separate process
+METRICS_EXPORT_INTERVAL_SECONDS = float(os.getenv("METRICS_EXPORT_INTERVAL_SECONDS", "10"))
+
+# BeQuick circuit breaker, per endpoint: opens when at least
+# BREAKER_ERROR_RATE of the calls in the last BREAKER_WINDOW_SECONDS failed
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+# Usage results per line: served from cache while fresh, refreshed in the
+# background once older than USAGE_REFRESH_AHEAD_SECONDS
+USAGE_CACHE_SIZE = int(os.getenv("USAGE_CACHE_SIZE", "10000"))
+USAGE_TTL_SECONDS = float(os.getenv("USAGE_TTL_SECONDS", "60"))
+USAGE_REFRESH_AHEAD_SECONDS = float(os.getenv("USAGE_REFRESH_AHEAD_SECONDS", "45"))
+# Last known usage per line, served (labelled stale) while BeQuick is unreachable
+USAGE_STALE_TTL_SECONDS = float(os.getenv("USAGE_STALE_TTL_SECONDS", str(24 * 3600)))
+
+# Manager bulk checks/refreshes: numbers per request, parallel BeQuick calls, lines per reply page
+BULK_MAX_NUMBERS = int(os.getenv("BULK_MAX_NUMBERS", "50"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+BULK_PAGE_SIZE = int(os.getenv("BULK_PAGE_SIZE", "20"))
+
+# Line refreshes (network_reset) run from a persistent job queue
+JOBS_DB = pathlib.Path(os.getenv("JOBS_DB", str(STAT_DIR / "jobs.db")))
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "4"))
+REFRESH_COOLDOWN_SECONDS = float(os.getenv("REFRESH_COOLDOWN_SECONDS", "300"))
+REFRESH_LEASE_SECONDS = float(os.getenv("REFRESH_LEASE_SECONDS", "120"))
+
+# Usage is looked up while the user is still typing the OTP code
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "4"))
+
+# Caches and sessions are carried over restarts through a snapshot file
+SNAPSHOT_FILE = pathlib.Path(os.getenv("SNAPSHOT_FILE", str(STAT_DIR / "snapshot.bin")))
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "60"))
 
-# Load BeQuick API token
-API_TOKEN = load_token('BEQUICK')
+# Logging: JSON lines written by a background thread. LOG_LEVELS and
+# LOG_SAMPLE take "category=value" pairs, e.g. "bequick.usage=0.1".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "bequick.usage=0.1,bequick.refresh=0.1")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
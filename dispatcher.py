@@ -0,0 +1,37 @@
+import queue
+import threading
+
+import log
+
+LOG = log.get("dispatch")
+
+
+class ShardedDispatcher:
+    def __init__(self, lanes: int, maxsize: int, name: str = "lane"):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(lanes)]
+        self.processed = [0] * lanes
+        self.failed = [0] * lanes
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._run, args=(i, q), name=f"{name}-{i}", daemon=True).start()
+
+    def lane(self, key: int) -> int:
+        return hash(key) % len(self.queues)
+
+    def submit(self, key: int, fn, *args, **kwargs):
+        # Blocks when the lane is full, which pushes back on the update source
+        self.queues[self.lane(key)].put((fn, args, kwargs))
+
+    def depths(self) -> list:
+        return [q.qsize() for q in self.queues]
+
+    def _run(self, i: int, q: queue.Queue):
+        while True:
+            fn, args, kwargs = q.get()
+            try:
+                fn(*args, **kwargs)
+                self.processed[i] += 1
+            except Exception as e:
+                self.failed[i] += 1
+                LOG.error("lane %d task failed: %s", i, e)
+            finally:
+                q.task_done()
@@ -1,23 +1,20 @@
-import os
+import time
+import functools
+import threading
 import requests
-import pathlib
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import bequick
+import config
+import log
+from cache import TTLCache, MISSING
+from singleflight import SingleFlight
+from jobs import JobQueue, COOLDOWN
 from utils import load_prompt, refresh_line
 from auth import normalize_mdn, get_line_id
 
-print("[DEBUG] Loaded features.py from:", __file__)
-
-# Base directory (folder where this file is located)
-BASE_DIR = pathlib.Path(__file__).resolve().parent
-
-# === Load BeQuick token ===
-dotenv_path = BASE_DIR / "secrets" / "pondsupportbot2" / "bequick.env"
-load_dotenv(dotenv_path)
-
-API_URL = "https://pondmobile-atom-api.bequickapps.com"
-API_TOKEN = os.getenv("BEQUICK_TOKEN")
-if not API_TOKEN:
-    raise ValueError("Token not found in bequick.env")
+USAGE_LOG = log.get("bequick.usage")
+REFRESH_LOG = log.get("bequick.refresh")
+BULK_LOG = log.get("bulk")
 
 
 # === Convert KB → MB/GB string ===
@@ -26,64 +23,291 @@ def kb_to_readable(kb_value: float) -> str:
     return f"{mb / 1024:.3f} GB" if mb >= 1024 else f"{mb:.2f} MB"
 
 
+def age_to_readable(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "less than a minute"
+    if minutes < 120:
+        return f"{minutes} min"
+    return f"{minutes // 60} h"
+
+
+USAGE_FLIGHTS = SingleFlight()
+# Entries are (usage, fetched_at); expired ones remain available to stale_usage
+USAGE_CACHE = TTLCache(config.USAGE_CACHE_SIZE, config.USAGE_TTL_SECONDS)
+REFRESHER = ThreadPoolExecutor(max_workers=2, thread_name_prefix="usage-refresh")
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
 # === Fetch data usage ===
+class UsageStatusError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"BeQuick returned status {status}")
+        self.status = status
+
+
 def check_usage(line_id: int | str):
-    url = f"{API_URL}/lines/{line_id}/query_service_details"
-    headers = {"X-AUTH-TOKEN": API_TOKEN, "Content-Type": "application/json"}
+    try:
+        usage, _ = load_usage(line_id)
+        return format_usage(usage)
+    except UsageStatusError as e:
+        template = load_prompt("usage_status")
+        return template.format(status=e.status)
+    except requests.exceptions.RequestException as e:
+        USAGE_LOG.warning("connection error: %s", e, extra={"line_id": line_id})
+        return stale_usage(line_id) or load_prompt("usage_error")
+
+
+# Served from cache while fresh; concurrent misses for one line share one upstream request
+def load_usage(line_id: int | str) -> tuple:
+    key = str(line_id)
+    entry = USAGE_CACHE.get(key)
+    if entry is MISSING:
+        return USAGE_FLIGHTS.do(key, fetch_usage, line_id)
+
+    _, fetched_at = entry
+    if time.time() - fetched_at >= config.USAGE_REFRESH_AHEAD_SECONDS:
+        schedule_refresh(line_id)
+    return entry
+
+
+def schedule_refresh(line_id: int | str):
+    key = str(line_id)
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+    REFRESHER.submit(refresh_usage, line_id)
 
-    print(f"[BeQuick Usage] Checking usage for line_id={line_id} at: {url}")
 
+def refresh_usage(line_id: int | str):
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        print(f"[BeQuick Usage] Status: {response.status_code}")
+        USAGE_FLIGHTS.do(str(line_id), fetch_usage, line_id)
+    except Exception as e:
+        USAGE_LOG.warning("background refresh failed: %s", e, extra={"line_id": line_id})
+    finally:
+        with refreshing_lock:
+            refreshing.discard(str(line_id))
 
-        if response.status_code != 200:
-            template = load_prompt("usage_status")
-            return template.format(status=response.status_code)
 
-        data = response.json() or {}
-        usage_summary = data.get("usage_summary", {})
-        data_usage = usage_summary.get("international_data", {})
+def invalidate_usage(line_id: int | str):
+    USAGE_CACHE.invalidate(str(line_id))
 
-        total_kb = float(data_usage.get("total", 0))
-        remaining_kb = float(data_usage.get("remaining", 0))
-        used_kb = float(data_usage.get("used_by_this_line", data_usage.get("used", 0)))
 
-        used_str = kb_to_readable(used_kb)
-        total_str = kb_to_readable(total_kb)
-        remaining_str = kb_to_readable(remaining_kb)
+def fetch_usage(line_id: int | str) -> tuple:
+    path = f"/lines/{line_id}/query_service_details"
 
-        template = load_prompt("usage")
-        return template.format(used=used_str, total=total_str, remaining=remaining_str)
+    response = bequick.get("check_usage", path)
+    USAGE_LOG.info("checked usage", extra={"line_id": line_id, "status": response.status_code})
 
-    except requests.exceptions.RequestException as e:
-        print(f"[BeQuick Usage] Connection error: {e}")
-        return load_prompt("usage_error")
+    if response.status_code != 200:
+        raise UsageStatusError(response.status_code)
+
+    entry = (parse_usage(response.json() or {}), time.time())
+    USAGE_CACHE.set(str(line_id), entry)
+    return entry
+
+
+def parse_usage(data: dict) -> dict:
+    usage_summary = data.get("usage_summary", {})
+    data_usage = usage_summary.get("international_data", {})
+    return {
+        "total": float(data_usage.get("total", 0)),
+        "remaining": float(data_usage.get("remaining", 0)),
+        "used": float(data_usage.get("used_by_this_line", data_usage.get("used", 0))),
+    }
+
+
+def format_usage(usage: dict) -> str:
+    template = load_prompt("usage")
+    return template.format(
+        used=kb_to_readable(usage["used"]),
+        total=kb_to_readable(usage["total"]),
+        remaining=kb_to_readable(usage["remaining"]),
+    )
+
+
+# === Last known usage while BeQuick is unreachable ===
+def stale_usage(line_id: int | str) -> str | None:
+    entry = USAGE_CACHE.get_stale(str(line_id))
+    if entry is MISSING:
+        return None
+    usage, fetched_at = entry
+    if time.time() - fetched_at > config.USAGE_STALE_TTL_SECONDS:
+        return None
+    template = load_prompt("usage_stale")
+    return template.format(age=age_to_readable(time.time() - fetched_at), usage=format_usage(usage))
 
 
 # === Handle refresh request ===
-def handle_refresh_request(phone_number: str):
+# The reset runs on the job queue; the chat gets the outcome as a follow-up message.
+# A job's result is the BeQuick status, or REFRESH_ERROR when it could not be reached.
+REFRESH_ERROR = "error"
+
+
+def handle_refresh_request(phone_number: str, chat_id: int, reply):
     mdn = normalize_mdn(phone_number)
     line_id = get_line_id(mdn)
 
     if not line_id:
-        return load_prompt("not_registered")
+        reply(load_prompt("not_registered"))
+        return
 
-    url = f"{API_URL}/lines/{line_id}/network_reset"
-    headers = {"X-AUTH-TOKEN": API_TOKEN, "Content-Type": "application/json"}
+    REFRESH_JOBS.submit(
+        str(line_id), mdn, chat_id,
+        on_outcome=lambda outcome: reply(load_prompt("refresh_cooldown" if outcome == COOLDOWN else "refresh_queued")),
+    )
 
-    print(f"[BeQuick Refresh] POST {url} (mdn={mdn})")
 
+def run_refresh_job(line_id: str, mdn: str) -> tuple:
     try:
-        response = requests.post(url, headers=headers, timeout=10)
-        print(f"[BeQuick Refresh] Status: {response.status_code}")
-
-        if response.status_code == 200:
-            return load_prompt("refresh_success")
+        status = reset_line(line_id, mdn)
+    except requests.exceptions.RequestException as e:
+        REFRESH_LOG.warning("connection error: %s", e, extra={"line_id": line_id})
+        return False, REFRESH_ERROR
+    return status == 200, str(status)
 
-        template = load_prompt("refresh_failed")
-        return template.format(status=response.status_code)
 
-    except requests.exceptions.RequestException as e:
-        print(f"[BeQuick Refresh] Connection error: {e}")
+def refresh_result_text(result: str) -> str:
+    if result == REFRESH_ERROR:
         return load_prompt("bequick_error")
+    if result == "200":
+        return load_prompt("refresh_success")
+    return load_prompt("refresh_failed").format(status=result)
+
+
+def bulk_refresh_result_line(mdn: str, result: str) -> str:
+    if result == REFRESH_ERROR:
+        return load_prompt("bulk_unavailable").format(mdn=mdn)
+    if result == "200":
+        return load_prompt("bulk_refresh_success").format(mdn=mdn)
+    return load_prompt("bulk_refresh_failed").format(mdn=mdn, status=result)
+
+
+def reset_line(line_id: int | str, mdn: str) -> int:
+    path = f"/lines/{line_id}/network_reset"
+
+    response = bequick.post("network_reset", path)
+    REFRESH_LOG.info("network reset for %s", mdn, extra={"line_id": line_id, "status": response.status_code})
+
+    if response.status_code == 200:
+        invalidate_usage(line_id)
+    return response.status_code
+
+
+REFRESH_JOBS = JobQueue(
+    config.JOBS_DB,
+    "network_reset",
+    run_refresh_job,
+    workers=config.REFRESH_WORKERS,
+    cooldown=config.REFRESH_COOLDOWN_SECONDS,
+    lease=config.REFRESH_LEASE_SECONDS,
+    error_result=REFRESH_ERROR,
+)
+
+
+# === Bulk manager operations ===
+BULK_POOL = ThreadPoolExecutor(max_workers=config.BULK_CONCURRENCY, thread_name_prefix="bulk")
+
+
+def bulk_usage_line(mdn: str) -> str:
+    line_id = get_line_id(mdn)
+    if not line_id:
+        return load_prompt("bulk_not_registered").format(mdn=mdn)
+    try:
+        usage, _ = load_usage(line_id)
+    except UsageStatusError as e:
+        return load_prompt("bulk_usage_status").format(mdn=mdn, status=e.status)
+    except requests.exceptions.RequestException:
+        entry = USAGE_CACHE.get_stale(str(line_id))
+        if entry is MISSING:
+            return load_prompt("bulk_unavailable").format(mdn=mdn)
+        usage, fetched_at = entry
+        return load_prompt("bulk_usage_stale").format(
+            mdn=mdn,
+            used=kb_to_readable(usage["used"]),
+            total=kb_to_readable(usage["total"]),
+            age=age_to_readable(time.time() - fetched_at),
+        )
+    return load_prompt("bulk_usage").format(
+        mdn=mdn,
+        used=kb_to_readable(usage["used"]),
+        total=kb_to_readable(usage["total"]),
+        remaining=kb_to_readable(usage["remaining"]),
+    )
+
+
+def bulk_refresh_line(mdn: str, chat_id: int, batch: int, position: int) -> str:
+    # Resets go through the job queue like single ones; the outcomes come back as one batch report
+    line_id = get_line_id(mdn)
+    if not line_id:
+        return load_prompt("bulk_not_registered").format(mdn=mdn)
+    if REFRESH_JOBS.submit(str(line_id), mdn, chat_id, batch=batch, position=position) == COOLDOWN:
+        return load_prompt("bulk_refresh_cooldown").format(mdn=mdn)
+    return load_prompt("bulk_refresh_queued").format(mdn=mdn)
+
+
+def bulk_report(kind: str, mdns: list, chat_id: int, done):
+    # One result line per number, in the order they were sent. Returns at once;
+    # done(lines) runs on the pool thread that finishes the last number.
+    if kind == "refresh":
+        batch = REFRESH_JOBS.open_batch(chat_id)
+        report = done
+
+        def fn(mdn, i):
+            return bulk_refresh_line(mdn, chat_id, batch, i)
+
+        def done(lines):
+            # report() queues the summary page, so the resets only start after it
+            try:
+                report(lines)
+            finally:
+                REFRESH_JOBS.release_batch(batch)
+    else:
+        def fn(mdn, i):
+            return bulk_usage_line(mdn)
+    lines = [None] * len(mdns)
+    remaining = [len(mdns)]
+    lock = threading.Lock()
+
+    def collect(i, mdn, future):
+        try:
+            lines[i] = future.result()
+        except Exception as e:
+            BULK_LOG.error("bulk %s line failed: %s", kind, e)
+            lines[i] = load_prompt("bulk_unavailable").format(mdn=mdn)
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            done(lines)
+        except Exception as e:
+            BULK_LOG.error("bulk %s report failed: %s", kind, e, extra={"chat_id": chat_id})
+
+    if not mdns:
+        done(lines)
+    for i, mdn in enumerate(mdns):
+        BULK_POOL.submit(fn, mdn, i).add_done_callback(functools.partial(collect, i, mdn))
+
+
+def paginate(header: str, lines: list, page_size: int) -> list:
+    chunks = [lines[i:i + page_size] for i in range(0, len(lines), page_size)] or [[]]
+    return [
+        f"{header} (page {n}/{len(chunks)})\n\n" + "\n".join(chunk)
+        for n, chunk in enumerate(chunks, start=1)
+    ]
+
+
+# === Usage prefetched during OTP verification ===
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=config.PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+def prefetch_usage(mdn: str):
+    return PREFETCH_POOL.submit(prefetched_usage, mdn)
+
+
+def prefetched_usage(mdn: str) -> tuple:
+    line_id = get_line_id(mdn)
+    return line_id, check_usage(line_id) if line_id else None
@@ -0,0 +1,107 @@
+import os
+import mmap
+import time
+import struct
+import pathlib
+import threading
+
+import config
+
+HEARTBEAT_FILE = config.STAT_DIR / "heartbeat"
+
+FIELDS = (
+    "pid",
+    "mode",
+    "started_at",
+    "beat_at",
+    "last_poll",
+    "last_update",
+    "last_bequick_ok",
+    "last_bequick_error",
+    "last_received",
+)
+LAYOUT = struct.Struct(f"<{len(FIELDS)}d")
+OFFSETS = {name: i * 8 for i, name in enumerate(FIELDS)}
+MODES = {"polling": 0.0, "webhook": 1.0}
+
+_writer = None
+_reader = None
+
+
+def _map(path: pathlib.Path, writable: bool) -> mmap.mmap:
+    flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+    fd = os.open(path, flags, 0o644)
+    try:
+        if writable and os.fstat(fd).st_size != LAYOUT.size:
+            os.ftruncate(fd, LAYOUT.size)
+        return mmap.mmap(fd, LAYOUT.size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def mark(field: str, value: float | None = None):
+    if _writer is not None:
+        struct.pack_into("<d", _writer, OFFSETS[field], time.time() if value is None else value)
+
+
+def start(mode: str):
+    global _writer
+    HEARTBEAT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    _writer = _map(HEARTBEAT_FILE, writable=True)
+    _writer[:] = bytes(LAYOUT.size)
+    mark("pid", os.getpid())
+    mark("mode", MODES[mode])
+    mark("started_at")
+    mark("beat_at")
+    threading.Thread(target=_beat, name="heartbeat", daemon=True).start()
+
+
+def _beat():
+    while True:
+        time.sleep(config.HEARTBEAT_INTERVAL_SECONDS)
+        mark("beat_at")
+
+
+def read() -> dict | None:
+    global _reader
+    if _reader is None:
+        try:
+            _reader = _map(HEARTBEAT_FILE, writable=False)
+        except (OSError, ValueError):
+            return None
+    return dict(zip(FIELDS, LAYOUT.unpack_from(_reader)))
+
+
+def status() -> dict:
+    hb = read()
+    now = time.time()
+    if not hb or now - hb["beat_at"] > config.HEARTBEAT_STALE_SECONDS:
+        return {"status": "down"}
+
+    def age(field):
+        return round(now - hb[field], 3) if hb[field] else None
+
+    report = {
+        "status": "up",
+        "mode": "webhook" if hb["mode"] == MODES["webhook"] else "polling",
+        "pid": int(hb["pid"]),
+        "uptime": age("started_at"),
+        "last_poll": age("last_poll"),
+        "last_received": age("last_received"),
+        "last_update": age("last_update"),
+        "last_bequick_ok": age("last_bequick_ok"),
+        "last_bequick_error": age("last_bequick_error"),
+        "problems": [],
+    }
+    if report["mode"] == "polling" and now - max(hb["last_poll"], hb["started_at"]) > config.POLL_STALE_SECONDS:
+        report["problems"].append("polling stalled")
+    # Updates are arriving but none has finished processing for a while: the lanes are stuck
+    backlog = hb["last_received"] > hb["last_update"]
+    if backlog and now - max(hb["last_update"], hb["started_at"]) > config.UPDATE_STALE_SECONDS:
+        report["problems"].append("updates stalled")
+    failing = hb["last_bequick_error"] > hb["last_bequick_ok"]
+    if failing and now - hb["last_bequick_error"] < config.BEQUICK_ERROR_WINDOW_SECONDS:
+        report["problems"].append("bequick failing")
+    if report["problems"]:
+        report["status"] = "degraded"
+    return report
@@ -0,0 +1,270 @@
+import time
+import pathlib
+import sqlite3
+import threading
+import contextlib
+
+import log
+
+LOG = log.get("jobs")
+
+SUBMITTED = "submitted"
+ATTACHED = "attached"
+COOLDOWN = "cooldown"
+
+# Finished jobs are kept this long for dedup and troubleshooting
+RETENTION_SECONDS = 86400
+
+# Claiming a job uses UPDATE ... RETURNING
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class JobQueue:
+    # One job per key at a time: repeat requests attach to the queued or running
+    # job, and a successful job blocks new ones for the cooldown window.
+    # Jobs live in SQLite, so they survive restarts and can be shared by
+    # several bot processes; a running job whose lease ran out is picked up again.
+    # Subscribers are told the handler's result, or error_result if it raised.
+    # A batch groups the jobs of one bulk request: its new jobs are held until
+    # release_batch, and its chat gets all the results at once when the last
+    # one is done.
+    def __init__(self, path: pathlib.Path, name: str, handler, workers: int, cooldown: float, lease: float,
+                 poll_interval: float = 1.0, error_result: str | None = None):
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError(f"[ERROR] SQLite {sqlite3.sqlite_version} is too old for the {name} job queue (needs 3.35+)")
+        self.path = path
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.cooldown = cooldown
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.error_result = error_result
+        self.notify = None
+        self.notify_batch = None
+        self.stats = {"submitted": 0, "attached": 0, "cooldown": 0, "done": 0, "failed": 0}
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        with self._db_lock:
+            if self._conn is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id INTEGER PRIMARY KEY, queue TEXT NOT NULL, key TEXT NOT NULL, payload TEXT NOT NULL, "
+                    "status TEXT NOT NULL, ok INTEGER, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+                    "created_at REAL NOT NULL, claimed_at REAL, finished_at REAL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (queue, key, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (queue, status, id)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS subscribers ("
+                    "job_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, PRIMARY KEY (job_id, chat_id))"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS batches ("
+                    "id INTEGER PRIMARY KEY, queue TEXT NOT NULL, chat_id INTEGER NOT NULL, "
+                    "released INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS batch_jobs ("
+                    "batch_id INTEGER NOT NULL, job_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+                    "PRIMARY KEY (batch_id, job_id))"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS batch_jobs_job ON batch_jobs (job_id)")
+                self._conn = conn
+            return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self.connect()
+        with self._db_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def submit(self, key: str, payload: str, chat_id: int, batch: int | None = None, position: int = 0,
+               on_outcome=None) -> str:
+        # on_outcome runs before the job can be claimed, so whatever it sends
+        # goes out ahead of the result notification. Within a batch the chat
+        # hears the result through the batch instead.
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, status, ok, finished_at FROM jobs WHERE queue = ? AND key = ? ORDER BY id DESC LIMIT 1",
+                (self.name, key),
+            ).fetchone()
+            if row and row[1] in ("held", "queued", "running"):
+                self._subscribe(conn, row[0], chat_id, batch, position)
+                outcome = ATTACHED
+            elif row and row[2] and row[3] > now - self.cooldown:
+                outcome = COOLDOWN
+            else:
+                cur = conn.execute(
+                    "INSERT INTO jobs (queue, key, payload, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.name, key, payload, "queued" if batch is None else "held", now),
+                )
+                self._subscribe(conn, cur.lastrowid, chat_id, batch, position)
+                outcome = SUBMITTED
+            if on_outcome:
+                on_outcome(outcome)
+        self.stats[outcome] += 1
+        if outcome == SUBMITTED and batch is None:
+            self.start()
+            self._wakeup.set()
+        return outcome
+
+    @staticmethod
+    def _subscribe(conn: sqlite3.Connection, job_id: int, chat_id: int, batch: int | None, position: int):
+        if batch is None:
+            conn.execute("INSERT OR IGNORE INTO subscribers (job_id, chat_id) VALUES (?, ?)", (job_id, chat_id))
+        else:
+            conn.execute(
+                "INSERT OR IGNORE INTO batch_jobs (batch_id, job_id, position) VALUES (?, ?, ?)", (batch, job_id, position)
+            )
+
+    def open_batch(self, chat_id: int) -> int:
+        with self._transaction() as conn:
+            return conn.execute(
+                "INSERT INTO batches (queue, chat_id, created_at) VALUES (?, ?, ?)", (self.name, chat_id, time.time())
+            ).lastrowid
+
+    def release_batch(self, batch: int):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'held' "
+                "AND id IN (SELECT job_id FROM batch_jobs WHERE batch_id = ?)",
+                (batch,),
+            )
+            conn.execute("UPDATE batches SET released = 1 WHERE id = ?", (batch,))
+            report = self._close_batch(conn, batch)
+        self.start()
+        self._wakeup.set()
+        if report:
+            self._notify_batch(*report)
+
+    def _close_batch(self, conn: sqlite3.Connection, batch: int) -> tuple | None:
+        # A released batch whose jobs are all done is reported once, by whoever closes it
+        row = conn.execute("SELECT chat_id FROM batches WHERE id = ? AND released = 1", (batch,)).fetchone()
+        if not row:
+            return None
+        items = conn.execute(
+            "SELECT j.payload, j.status, j.result FROM batch_jobs b JOIN jobs j ON j.id = b.job_id "
+            "WHERE b.batch_id = ? ORDER BY b.position",
+            (batch,),
+        ).fetchall()
+        if any(status != "done" for _, status, _ in items):
+            return None
+        conn.execute("DELETE FROM batch_jobs WHERE batch_id = ?", (batch,))
+        conn.execute("DELETE FROM batches WHERE id = ?", (batch,))
+        return row[0], [(payload, result) for payload, _, result in items]
+
+    def _notify_batch(self, chat_id: int, items: list):
+        if not self.notify_batch or not items:
+            return
+        try:
+            self.notify_batch(chat_id, items)
+        except Exception as e:
+            LOG.error("%s: batch report for chat %d failed: %s", self.name, chat_id, e)
+
+    def depth(self) -> int:
+        conn = self.connect()
+        with self._db_lock:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ? AND status IN ('held', 'queued', 'running')", (self.name,)
+            ).fetchone()[0]
+
+    def start(self):
+        # Also picks up jobs left queued or running by a previous process
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True).start()
+
+    def _claim(self) -> tuple | None:
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id = (SELECT id FROM jobs WHERE queue = ? AND "
+                "(status = 'queued' OR (status = 'running' AND claimed_at < ?)) ORDER BY id LIMIT 1) "
+                "RETURNING id, key, payload",
+                (now, self.name, now - self.lease),
+            ).fetchone()
+
+    def _finish(self, job_id: int, ok: bool, result: str) -> tuple:
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', ok = ?, result = ?, finished_at = ? WHERE id = ?",
+                (int(ok), result, time.time(), job_id),
+            )
+            chats = [r[0] for r in conn.execute("SELECT chat_id FROM subscribers WHERE job_id = ?", (job_id,))]
+            conn.execute("DELETE FROM subscribers WHERE job_id = ?", (job_id,))
+            batches = [r[0] for r in conn.execute("SELECT batch_id FROM batch_jobs WHERE job_id = ?", (job_id,))]
+            reports = [report for batch in batches if (report := self._close_batch(conn, batch))]
+        return chats, reports
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned_at < 600:
+            return
+        self._pruned_at = now
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE queue = ? AND status = 'done' AND finished_at < ?",
+                (self.name, now - RETENTION_SECONDS),
+            )
+            # Batches whose requester died before releasing them
+            stale = [r[0] for r in conn.execute(
+                "SELECT id FROM batches WHERE queue = ? AND released = 0 AND created_at < ?", (self.name, now - self.lease)
+            )]
+        for batch in stale:
+            self.release_batch(batch)
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                LOG.error("%s: claim failed: %s", self.name, e)
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                try:
+                    self._prune()
+                except sqlite3.Error as e:
+                    LOG.error("%s: prune failed: %s", self.name, e)
+                continue
+
+            job_id, key, payload = job
+            try:
+                ok, result = self.handler(key, payload)
+            except Exception as e:
+                LOG.error("%s: job %d failed: %s", self.name, job_id, e)
+                ok, result = False, self.error_result
+            self.stats["done" if ok else "failed"] += 1
+            try:
+                chats, reports = self._finish(job_id, ok, result)
+            except sqlite3.Error as e:
+                LOG.error("%s: could not record job %d: %s", self.name, job_id, e)
+                continue
+            if self.notify and result:
+                for chat_id in chats:
+                    self.notify(chat_id, payload, result)
+            for report in reports:
+                self._notify_batch(*report)
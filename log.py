@@ -0,0 +1,113 @@
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+import config
+
+ROOT = "pond"
+
+# Phone numbers keep their last four digits; tokens and secrets are dropped entirely
+MDN_PATTERN = re.compile(r"(?<!\d)(?:\+?1[\s.-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?(\d{4})(?!\d)")
+BOT_TOKEN_PATTERN = re.compile(r"\d{5,}:[A-Za-z0-9_-]{20,}")
+SECRET_PATTERN = re.compile(r"(?i)((?:token|secret|password|auth)[\w-]*[\"']?\s*[:=]\s*[\"']?)[^\s\"',}&]+")
+
+# Attributes every LogRecord has; anything else came in through extra=
+RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+stats = {"queued": 0, "dropped": 0, "sampled_out": 0}
+
+
+def redact(text: str) -> str:
+    text = BOT_TOKEN_PATTERN.sub("<token>", text)
+    text = SECRET_PATTERN.sub(r"\1<redacted>", text)
+    return MDN_PATTERN.sub(lambda m: "***" + m.group(1), text)
+
+
+def parse_pairs(spec: str) -> dict:
+    pairs = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "category": record.name[len(ROOT) + 1:] or ROOT,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED:
+                entry[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_text:
+            entry["exc"] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    # Only routine records are sampled; warnings and errors always get through
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None or random.random() < rate:
+            return True
+        stats["sampled_out"] += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller: when the writer falls behind, records are counted and dropped
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            stats["queued"] += 1
+        except queue.Full:
+            stats["dropped"] += 1
+
+
+def setup() -> logging.handlers.QueueListener:
+    root = logging.getLogger(ROOT)
+    root.setLevel(config.LOG_LEVEL.upper())
+    root.propagate = False
+    for category, level in parse_pairs(config.LOG_LEVELS).items():
+        logging.getLogger(f"{ROOT}.{category}").setLevel(level.upper())
+
+    handler = DroppingQueueHandler(queue.Queue(maxsize=config.LOG_QUEUE_SIZE))
+    handler.addFilter(SampleFilter({
+        f"{ROOT}.{category}": float(rate) for category, rate in parse_pairs(config.LOG_SAMPLE).items()
+    }))
+    root.addHandler(handler)
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def get(category: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT}.{category}")
+
+
+LISTENER = setup()
@@ -0,0 +1,184 @@
+import os
+import time
+import bisect
+import threading
+import functools
+
+import config
+import log
+
+LOG = log.get("metrics")
+
+METRICS_FILE = config.STAT_DIR / "metrics.prom"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+LIVE = threading.Event()
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, n: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + n
+
+    def value(self, *labelvalues) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for values, v in items:
+            yield f"{self.name}{_labels(self.labelnames, values)} {v}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), fn=None):
+        # fn() returns {labelvalues tuple: value} and is read at scrape time
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.fn = fn
+        REGISTRY.append(self)
+
+    def samples(self):
+        try:
+            values = self.fn()
+        except Exception:
+            return
+        for labelvalues, v in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {v}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        with self._lock:
+            items = [(values, (list(s[0]), s[1], s[2])) for values, s in self._series.items()]
+        names = self.labelnames + ("le",)
+        for values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_labels(names, values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, values)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, values)} {count}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labelvalues", "started")
+
+    def __init__(self, histogram: Histogram, labelvalues: tuple):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+        return False
+
+
+def timed(histogram: Histogram, label):
+    # label(*args) picks the label value from the handler's arguments
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(label(*args)):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def export():
+    tmp = METRICS_FILE.with_suffix(".tmp")
+    tmp.write_text(render(), encoding="utf8")
+    os.replace(tmp, METRICS_FILE)
+
+
+def start_export():
+    LIVE.set()
+    METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+
+    def run():
+        while True:
+            try:
+                export()
+            except OSError as e:
+                LOG.error("export failed: %s", e)
+            time.sleep(config.METRICS_EXPORT_INTERVAL_SECONDS)
+
+    threading.Thread(target=run, name="metrics-export", daemon=True).start()
+
+
+def scrape() -> str:
+    # Same process as the bot (webhook mode): render live; otherwise serve the bot's last export
+    if LIVE.is_set():
+        return render()
+    try:
+        return METRICS_FILE.read_text(encoding="utf8")
+    except OSError:
+        return render()
+
+
+BEQUICK_SECONDS = Histogram("bequick_request_seconds", "BeQuick API call latency", ("endpoint",))
+BEQUICK_ERRORS = Counter("bequick_errors_total", "BeQuick API calls that failed", ("endpoint", "kind"))
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Telegram sendMessage latency", ("bot",))
+TELEGRAM_SEND_ERRORS = Counter("telegram_send_errors_total", "Telegram sendMessage failures", ("bot", "kind"))
+HANDLER_SECONDS = Histogram("handler_seconds", "Bot handler duration", ("handler",))
+OTP_EVENTS = Counter("otp_events_total", "OTP funnel events", ("event",))
+PREFETCH_EVENTS = Counter("usage_prefetch_total", "Usage lookups started before OTP verification", ("event",))
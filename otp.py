@@ -1,68 +1,121 @@
+import hmac
 import time
+import hashlib
+import functools
 import secrets
 
-OTP_TTL_SECONDS = 60
-OTP_MAX_ATTEMPTS = 3
+import config
+import sessions
+import metrics
+
+# Codes are never stored in plaintext, only as an HMAC under a key shared
+# through the state backend, so any bot process can check a code. Looked up
+# on first use, after a startup snapshot may have restored it.
+@functools.cache
+def hash_key() -> bytes:
+    return sessions.STORE.shared_key("otp")
 
-otp_state = {}
 
 def generate_code() -> str:
     return f"{secrets.randbelow(1_000_000):06d}"
 
-def start(chat_id: int, mdn: str) -> str:
+def hash_code(chat_id: int, code: str) -> str:
+    return hmac.new(hash_key(), f"{chat_id}:{code}".encode(), hashlib.sha256).hexdigest()
+
+def state(chat_id: int) -> dict | None:
+    s = sessions.STORE.peek(chat_id)
+    return s.otp if s else None
+
+def clear(chat_id: int, outcome: str | None = None):
+    s = sessions.STORE.peek(chat_id)
+    if s and s.otp:
+        s.otp = None
+        sessions.STORE.save(s)
+        if outcome:
+            metrics.OTP_EVENTS.inc(outcome)
+
+def start(chat_id: int, mdn: str) -> str | None:
+    # Issuance limits live in the state backend so they hold across bot processes
+    if not sessions.STORE.take_slots([
+        (f"otp:chat:{chat_id}", config.OTP_CHAT_LIMIT, config.OTP_CHAT_WINDOW_SECONDS),
+        (f"otp:mdn:{mdn}", config.OTP_MDN_LIMIT, config.OTP_MDN_WINDOW_SECONDS),
+    ]):
+        metrics.OTP_EVENTS.inc("throttled")
+        return None
+
     code = generate_code()
-    otp_state[chat_id] = {
-        "code": code,
-        "expires_at": time.time() + OTP_TTL_SECONDS,
-        "attempts_left": OTP_MAX_ATTEMPTS,
+    record = {
+        "code_hash": hash_code(chat_id, code),
+        "expires_at": time.time() + config.OTP_TTL_SECONDS,
+        "attempts_left": config.OTP_MAX_ATTEMPTS,
         "mdn": mdn,
     }
+    s = sessions.STORE.get(chat_id)
+    s.otp = record
+    sessions.STORE.save(s)
+    sessions.SWEEPER.schedule(config.OTP_TTL_SECONDS, expire, chat_id, record)
+    metrics.OTP_EVENTS.inc("issued")
     return code
 
+def reissue(chat_id: int) -> str | None:
+    s = state(chat_id)
+    if not s:
+        return None
+    return start(chat_id, s["mdn"])
+
+def expire(chat_id: int, record: dict):
+    # Scheduled at issue time; a newer code for the same chat is left alone.
+    # Runs on the sweeper, so it takes the chat like an update would
+    with sessions.STORE.batch(chat_id):
+        s = state(chat_id)
+        if s and s["code_hash"] == record["code_hash"]:
+            clear(chat_id, "expired")
+
+def rearm(chat_id: int):
+    # A restored record lost its expire entry with the process that issued it
+    s = state(chat_id)
+    if s:
+        sessions.SWEEPER.schedule(max(0.0, s["expires_at"] - time.time()), expire, chat_id, s)
+
 def is_waiting(chat_id: int) -> bool:
-    s = otp_state.get(chat_id)
+    s = state(chat_id)
     if not s:
         return False
     if time.time() > s["expires_at"]:
-        otp_state.pop(chat_id, None)
+        clear(chat_id, "expired")
         return False
     return True
 
-def peek_code(chat_id: int) -> str | None:
-    s = otp_state.get(chat_id)
-    if not s:
-        return None
-    if time.time() > s["expires_at"]:
-        otp_state.pop(chat_id, None)
-        return None
-    return s.get("code")
-
 def verify(chat_id: int, user_input: str) -> str:
-    s = otp_state.get(chat_id)
+    # The guess is charged atomically before it is checked, so concurrent
+    # guesses (from any process) can never exceed OTP_MAX_ATTEMPTS
+    s = sessions.STORE.spend_otp_attempt(chat_id)
     if not s:
         return "NO_SESSION"
 
     if time.time() > s["expires_at"]:
-        otp_state.pop(chat_id, None)
+        clear(chat_id, "expired")
         return "EXPIRED"
 
     if s["attempts_left"] <= 0:
-        otp_state.pop(chat_id, None)
+        clear(chat_id, "locked")
         return "LOCKED"
 
     clean = "".join(ch for ch in (user_input or "") if ch.isdigit())
-    if clean == s["code"]:
+    if hmac.compare_digest(hash_code(chat_id, clean), s["code_hash"]):
+        metrics.OTP_EVENTS.inc("verified")
         return "OK"
 
-    s["attempts_left"] -= 1
-    if s["attempts_left"] <= 0:
-        otp_state.pop(chat_id, None)
+    metrics.OTP_EVENTS.inc("wrong")
+    if s["attempts_left"] <= 1:
+        clear(chat_id, "locked")
         return "LOCKED"
 
     return "WRONG"
 
 def consume_mdn(chat_id: int):
-    s = otp_state.pop(chat_id, None)
+    s = state(chat_id)
     if not s:
         return None
+    clear(chat_id)
     return s.get("mdn")
@@ -0,0 +1,215 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from telebot import apihelper
+
+import config
+import log
+import metrics
+
+LOG = log.get("send")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        # Takes a token if one is available, otherwise says how long to wait
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+CHAT_BUCKETS_MAX = 10000
+
+
+class ChatQueue:
+    __slots__ = ("messages", "bucket", "busy", "scheduled")
+
+    def __init__(self):
+        self.messages = deque()
+        self.bucket = TokenBucket(config.SEND_CHAT_RATE, config.SEND_CHAT_BURST)
+        # busy: a worker is delivering the head message; scheduled: the chat is in the ready heap
+        self.busy = False
+        self.scheduled = False
+
+
+def prune_idle(chats: dict):
+    cutoff = time.monotonic() - 60
+    for chat_id in [
+        c for c, q in chats.items()
+        if not q.messages and not q.busy and not q.scheduled and q.bucket.updated < cutoff
+    ]:
+        del chats[chat_id]
+
+
+def retry_after(e: apihelper.ApiTelegramException) -> float | None:
+    if e.error_code != 429:
+        return None
+    params = (e.result_json or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+class Outbox:
+    # Each chat has its own FIFO and rate bucket; chats with messages wait in a
+    # heap ordered by when their bucket allows the next send. A worker takes
+    # the earliest eligible chat, so a chat over its rate never holds up the
+    # others, and a chat is served by one worker at a time to keep its order.
+    def __init__(self, tb, name: str, workers: int = config.SEND_WORKERS, maxsize: int = config.SEND_QUEUE_SIZE):
+        self.tb = tb
+        self.name = name
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(config.SEND_GLOBAL_RATE, config.SEND_GLOBAL_RATE)
+        self.chats = {}
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "rate_limited": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+        self._ready = []
+        self._seq = itertools.count()
+        self._pending = 0
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-send-{i}", daemon=True).start()
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> Future | None:
+        future = Future()
+        with self._cond:
+            if self._pending >= self.maxsize:
+                self.stats["dropped"] += 1
+                LOG.warning("queue full, dropped message", extra={"bot": self.name, "chat_id": chat_id})
+                return None
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                if len(self.chats) >= CHAT_BUCKETS_MAX:
+                    prune_idle(self.chats)
+                chat = self.chats[chat_id] = ChatQueue()
+            # [text, kwargs, future, enqueued_at, attempts]
+            chat.messages.append([text, kwargs, future, time.monotonic(), 0])
+            self._pending += 1
+            self.stats["queued"] += 1
+            self._schedule(chat_id, chat, 0.0)
+        return future
+
+    def depth(self) -> int:
+        return self._pending
+
+    def _schedule(self, chat_id: int, chat: ChatQueue, at: float):
+        # Caller holds self._cond
+        if chat.busy or chat.scheduled or not chat.messages:
+            return
+        chat.scheduled = True
+        heapq.heappush(self._ready, (at, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _next(self) -> tuple:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    chat = self.chats[chat_id]
+                    chat.scheduled = False
+                    wait = chat.bucket.delay()
+                    if wait > 0:
+                        self._schedule(chat_id, chat, now + wait)
+                        continue
+                    chat.busy = True
+                    return chat_id, chat, chat.messages[0]
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _run(self):
+        while True:
+            chat_id, chat, message = self._next()
+            text, kwargs, future, enqueued_at, _ = message
+            try:
+                outcome = self._deliver(chat_id, text, kwargs)
+            except Exception as e:
+                LOG.error("unexpected error: %s", e, extra={"bot": self.name, "chat_id": chat_id})
+                outcome = False
+            retry_in = 0.0
+            if outcome is None:
+                # Retried later without holding the worker; later messages of the chat wait behind it
+                message[4] += 1
+                if message[4] >= config.SEND_MAX_ATTEMPTS:
+                    self.stats["failed"] += 1
+                    outcome = False
+                else:
+                    retry_in = min(0.5 * 2 ** message[4], 8.0)
+            with self._cond:
+                chat.busy = False
+                if outcome is not None:
+                    chat.messages.popleft()
+                    self._pending -= 1
+                self._schedule(chat_id, chat, time.monotonic() + retry_in)
+            if outcome is not None:
+                latency = time.monotonic() - enqueued_at
+                self.stats["latency_total"] += latency
+                self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                future.set_result(outcome)
+
+    def _deliver(self, chat_id: int, text: str, kwargs: dict) -> bool | None:
+        # True: sent, False: rejected for good, None: worth another attempt
+        self.bucket.acquire()
+        started = time.perf_counter()
+        try:
+            self.tb.send_message(chat_id, text, **kwargs)
+            metrics.TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, self.name)
+            self.stats["sent"] += 1
+            return True
+        except apihelper.ApiTelegramException as e:
+            metrics.TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, self.name)
+            metrics.TELEGRAM_SEND_ERRORS.inc(self.name, f"api_{e.error_code}")
+            if e.error_code >= 500:
+                return None
+            wait = retry_after(e)
+            if wait is None:
+                self.stats["failed"] += 1
+                LOG.warning("%s", e.description, extra={"bot": self.name, "chat_id": chat_id})
+                return False
+            # 429: hold every send of this bot for the time Telegram asked for
+            self.stats["rate_limited"] += 1
+            self.bucket.pause(wait)
+            return None
+        except Exception as e:
+            metrics.TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, self.name)
+            metrics.TELEGRAM_SEND_ERRORS.inc(self.name, "network")
+            LOG.warning("send failed: %s", e, extra={"bot": self.name, "chat_id": chat_id})
+            return None
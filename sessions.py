@@ -0,0 +1,535 @@
+import sys
+import json
+import time
+import heapq
+import pathlib
+import secrets
+import sqlite3
+import itertools
+import threading
+import contextlib
+from collections import OrderedDict, deque
+
+import config
+import log
+
+LOG = log.get("sessions")
+
+
+class Session:
+    __slots__ = (
+        "chat_id",
+        "mdn",
+        "action",
+        "manager_state",
+        "post_otp_action",
+        "verified_until",
+        "otp_bot_allowed",
+        "otp",
+        "bulk_pages",
+        "touched_at",
+        "version",
+    )
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.mdn = None
+        self.action = None
+        self.manager_state = None
+        self.post_otp_action = None
+        self.verified_until = 0.0
+        self.otp_bot_allowed = False
+        self.otp = None
+        self.bulk_pages = None
+        self.touched_at = time.monotonic()
+        # Row version in the SQLite store; 0 means not written yet
+        self.version = 0
+
+    def footprint(self) -> int:
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            size += sys.getsizeof(value)
+            if isinstance(value, list):
+                size += sum(sys.getsizeof(v) for v in value)
+            if isinstance(value, dict):
+                size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+        return size
+
+    def dump(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in PERSISTED})
+
+    @classmethod
+    def load(cls, chat_id: int, data: str) -> "Session":
+        s = cls(chat_id)
+        for name, value in json.loads(data).items():
+            if name in PERSISTED:
+                setattr(s, name, value)
+        return s
+
+
+# touched_at is process-local (monotonic) and version is the store's own
+# bookkeeping; the SQLite store tracks idleness itself
+PERSISTED = tuple(name for name in Session.__slots__ if name not in ("chat_id", "touched_at", "version"))
+
+
+def spend_attempt(s: Session) -> dict | None:
+    # Charges one OTP guess and returns the record as it was before the charge
+    if not s or not s.otp:
+        return None
+    before = dict(s.otp)
+    s.otp = {**s.otp, "attempts_left": s.otp["attempts_left"] - 1}
+    return before
+
+
+class Sweeper:
+    def __init__(self, name: str = "sweeper"):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def schedule(self, delay: float, fn, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), fn, args))
+            self._cond.notify()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, fn, args = heapq.heappop(self._heap)
+            try:
+                fn(*args)
+            except Exception as e:
+                LOG.error("sweeper task %s failed: %s", getattr(fn, "__name__", fn), e)
+
+
+SWEEPER = Sweeper()
+
+# How often expired rate-limit slots are dropped
+SLOT_PRUNE_SECONDS = 600.0
+
+# Chats share this many in-process locks; a batch holds its chat's one
+CHAT_LOCK_STRIPES = 64
+
+
+class SessionStore:
+    def __init__(self, maxsize: int, idle_ttl: float, sweeper: Sweeper):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.sweeper = sweeper
+        self.evicted = 0
+        self.expired = 0
+        self._data = OrderedDict()
+        self._keys = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self.sweeper.schedule(SLOT_PRUNE_SECONDS, self._prune_slots)
+
+    def get(self, chat_id: int) -> Session:
+        with self._lock:
+            s = self._data.get(chat_id)
+            if s is None:
+                s = self._data[chat_id] = Session(chat_id)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evicted += 1
+                self.sweeper.schedule(self.idle_ttl, self._expire, chat_id)
+            else:
+                self._data.move_to_end(chat_id)
+                s.touched_at = time.monotonic()
+            return s
+
+    def peek(self, chat_id: int) -> Session | None:
+        return self._data.get(chat_id)
+
+    def drop(self, chat_id: int):
+        with self._lock:
+            self._data.pop(chat_id, None)
+
+    # Sessions are live objects here, so there is nothing to write back
+    @contextlib.contextmanager
+    def batch(self, chat_id: int):
+        yield
+
+    def save(self, s: Session):
+        pass
+
+    def shared_key(self, name: str) -> bytes:
+        with self._lock:
+            return self._keys.setdefault(name, secrets.token_bytes(32))
+
+    def spend_otp_attempt(self, chat_id: int) -> dict | None:
+        with self._lock:
+            return spend_attempt(self._data.get(chat_id))
+
+    def take_slots(self, limits: list) -> bool:
+        # limits: [(key, limit, window)]; all are checked before any is charged
+        now = time.time()
+        with self._lock:
+            hits = []
+            for key, limit, window in limits:
+                recent = self._slots.setdefault(key, deque())
+                while recent and recent[0] <= now:
+                    recent.popleft()
+                if len(recent) >= limit:
+                    return False
+                hits.append((recent, window))
+            for recent, window in hits:
+                recent.append(now + window)
+            return True
+
+    def _prune_slots(self):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, recent in self._slots.items() if not recent or recent[-1] <= now]:
+                del self._slots[key]
+        self.sweeper.schedule(SLOT_PRUNE_SECONDS, self._prune_slots)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            items = [
+                (s.chat_id, tuple(getattr(s, name) for name in PERSISTED), now - s.touched_at)
+                for s in self._data.values()
+            ]
+            keys = dict(self._keys)
+        return {"fields": PERSISTED, "sessions": items, "keys": keys}
+
+    def restore(self, data: dict, elapsed: float) -> list:
+        now = time.monotonic()
+        restored = []
+        with self._lock:
+            self._keys.update(data["keys"])
+            for chat_id, values, idle in data["sessions"]:
+                idle += elapsed
+                if idle >= self.idle_ttl or chat_id in self._data:
+                    continue
+                s = Session(chat_id)
+                for name, value in zip(data["fields"], values):
+                    if name in PERSISTED:
+                        setattr(s, name, value)
+                s.touched_at = now - idle
+                self._data[chat_id] = s
+                self.sweeper.schedule(self.idle_ttl - idle, self._expire, chat_id)
+                restored.append(chat_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return restored
+
+    def _expire(self, chat_id: int):
+        # One sweeper entry per session: a touched session is re-armed for the rest of its idle window
+        with self._lock:
+            s = self._data.get(chat_id)
+            if s is None:
+                return
+            idle = time.monotonic() - s.touched_at
+            if idle < self.idle_ttl:
+                self.sweeper.schedule(self.idle_ttl - idle, self._expire, chat_id)
+                return
+            del self._data[chat_id]
+            self.expired += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def footprint(self) -> int:
+        with self._lock:
+            sessions = list(self._data.values())
+        return sys.getsizeof(self._data) + sum(s.footprint() for s in sessions)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "bytes": self.footprint(),
+        }
+
+
+class SQLiteSessionStore:
+    # Sessions are loaded at the start of an update and written back when it
+    # is done; several processes share the database via WAL. A batch holds the
+    # chat's lease (a striped lock in this process, a leases row across
+    # processes), so one chat is handled by one thread at a time everywhere.
+    # Writes are still conditional on the row version that was loaded, so a
+    # holder whose lease ran out cannot undo a newer write. Security counters
+    # (OTP guesses, issuance slots) are changed inside a single write transaction.
+    def __init__(self, path: pathlib.Path, idle_ttl: float, sweeper: Sweeper, lease: float):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.sweeper = sweeper
+        self.lease = lease
+        self.owner = secrets.token_hex(8)
+        self.expired = 0
+        self.conflicts = 0
+        self.lease_waits = 0
+        self._local = threading.local()
+        self._db_lock = threading.Lock()
+        self._chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+        self._conn = None
+        self.sweeper.schedule(min(idle_ttl, 60.0), self._sweep)
+
+    def connect(self) -> sqlite3.Connection:
+        with self._db_lock:
+            if self._conn is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+                    "version INTEGER NOT NULL DEFAULT 1)"
+                )
+                if "version" not in {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}:
+                    conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+                conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS slots (key TEXT NOT NULL, expires_at REAL NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS slots_key ON slots (key, expires_at)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS leases (chat_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.commit()
+                self._conn = conn
+            return self._conn
+
+    def _load(self, chat_id: int) -> Session | None:
+        conn = self.connect()
+        with self._db_lock:
+            return self._select(conn, chat_id)
+
+    def _select(self, conn: sqlite3.Connection, chat_id: int) -> Session | None:
+        row = conn.execute(
+            "SELECT data, version FROM sessions WHERE chat_id = ? AND updated_at >= ?",
+            (chat_id, time.time() - self.idle_ttl),
+        ).fetchone()
+        if not row:
+            return None
+        s = Session.load(chat_id, row[0])
+        s.version = row[1]
+        return s
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write
+        # inside it cannot interleave with another process
+        conn = self.connect()
+        with self._db_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def _lookup(self, chat_id: int, create: bool) -> Session | None:
+        batch = getattr(self._local, "batch", None)
+        if batch is not None and chat_id in batch:
+            return batch[chat_id]
+        s = self._load(chat_id)
+        if s is None and create:
+            s = Session(chat_id)
+        if s is not None and batch is not None:
+            batch[chat_id] = s
+        return s
+
+    def get(self, chat_id: int) -> Session:
+        return self._lookup(chat_id, create=True)
+
+    def peek(self, chat_id: int) -> Session | None:
+        return self._lookup(chat_id, create=False)
+
+    def drop(self, chat_id: int):
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.pop(chat_id, None)
+        conn = self.connect()
+        with self._db_lock, conn:
+            conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    @contextlib.contextmanager
+    def batch(self, chat_id: int):
+        # Every session touched inside the block is written back once at the end,
+        # before the chat's lease is released. A nested block joins the outer one.
+        if getattr(self._local, "batch", None) is not None:
+            yield
+            return
+        with self._chat_locks[chat_id % CHAT_LOCK_STRIPES], self._leased(chat_id):
+            self._local.batch = {}
+            try:
+                yield
+            finally:
+                batch, self._local.batch = self._local.batch, None
+                if batch:
+                    self._write(batch.values())
+
+    @contextlib.contextmanager
+    def _leased(self, chat_id: int):
+        deadline = time.monotonic() + self.lease
+        delay = 0.01
+        while not self._take_lease(chat_id):
+            self.lease_waits += 1
+            if time.monotonic() >= deadline:
+                # Only a holder far past its own lease gets here; the version check still applies
+                LOG.warning("chat lease not released in time, going ahead", extra={"chat_id": chat_id})
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            try:
+                conn = self.connect()
+                with self._db_lock, conn:
+                    conn.execute("DELETE FROM leases WHERE chat_id = ? AND owner = ?", (chat_id, self.owner))
+            except sqlite3.Error as e:
+                LOG.error("lease release failed: %s", e, extra={"chat_id": chat_id})
+
+    def _take_lease(self, chat_id: int) -> bool:
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                return conn.execute(
+                    "INSERT INTO leases (chat_id, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE leases.expires_at < ? RETURNING chat_id",
+                    (chat_id, self.owner, now + self.lease, now),
+                ).fetchone() is not None
+        except sqlite3.Error as e:
+            # Better to handle the update unleased than to drop it
+            LOG.error("lease failed: %s", e, extra={"chat_id": chat_id})
+            return True
+
+    def save(self, s: Session):
+        self._write([s])
+
+    def _write(self, items):
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                for s in items:
+                    if s.version:
+                        row = conn.execute(
+                            "UPDATE sessions SET data = ?, updated_at = ?, version = version + 1 "
+                            "WHERE chat_id = ? AND version = ? RETURNING version",
+                            (s.dump(), now, s.chat_id, s.version),
+                        ).fetchone()
+                    else:
+                        # A new session may replace a row that has only gone idle
+                        row = conn.execute(
+                            "INSERT INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?) "
+                            "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, "
+                            "updated_at = excluded.updated_at, version = version + 1 "
+                            "WHERE sessions.updated_at < ? RETURNING version",
+                            (s.chat_id, s.dump(), now, now - self.idle_ttl),
+                        ).fetchone()
+                    if row:
+                        s.version = row[0]
+                    else:
+                        self.conflicts += 1
+                        LOG.warning("session changed by another process, update discarded", extra={"chat_id": s.chat_id})
+        except sqlite3.Error as e:
+            LOG.error("write of %d sessions failed: %s", len(items), e)
+
+    def spend_otp_attempt(self, chat_id: int) -> dict | None:
+        with self._transaction() as conn:
+            s = self._select(conn, chat_id)
+            before = spend_attempt(s)
+            if before is None:
+                return None
+            s.version = conn.execute(
+                "UPDATE sessions SET data = ?, updated_at = ?, version = version + 1 WHERE chat_id = ? RETURNING version",
+                (s.dump(), time.time(), chat_id),
+            ).fetchone()[0]
+        # Keep this update's copy in step, or its write-back would be refused as stale
+        batch = getattr(self._local, "batch", None)
+        if batch is not None and chat_id in batch:
+            batch[chat_id].otp = s.otp
+            batch[chat_id].version = s.version
+        return before
+
+    def take_slots(self, limits: list) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            for key, limit, window in limits:
+                used = conn.execute(
+                    "SELECT COUNT(*) FROM slots WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()[0]
+                if used >= limit:
+                    return False
+            conn.executemany(
+                "INSERT INTO slots (key, expires_at) VALUES (?, ?)",
+                [(key, now + window) for key, _, window in limits],
+            )
+        return True
+
+    # Already durable, nothing to carry over a restart
+    def snapshot(self) -> None:
+        return None
+
+    def restore(self, data: dict, elapsed: float) -> list:
+        return []
+
+    def shared_key(self, name: str) -> bytes:
+        # Generated by whichever process gets there first, then shared by all
+        conn = self.connect()
+        with self._db_lock, conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (name, secrets.token_bytes(32)))
+            return conn.execute("SELECT value FROM meta WHERE key = ?", (name,)).fetchone()[0]
+
+    def _sweep(self):
+        conn = self.connect()
+        try:
+            with self._db_lock, conn:
+                cur = conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_ttl,))
+                self.expired += cur.rowcount
+                conn.execute("DELETE FROM slots WHERE expires_at <= ?", (time.time(),))
+                conn.execute("DELETE FROM leases WHERE expires_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            LOG.error("sweep failed: %s", e)
+        self.sweeper.schedule(min(self.idle_ttl, 60.0), self._sweep)
+
+    def __len__(self) -> int:
+        conn = self.connect()
+        with self._db_lock:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def footprint(self) -> int:
+        conn = self.connect()
+        with self._db_lock:
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return pages * page_size
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self),
+            "expired": self.expired,
+            "conflicts": self.conflicts,
+            "lease_waits": self.lease_waits,
+            "bytes": self.footprint(),
+        }
+
+
+def open_store():
+    if config.STATE_BACKEND == "sqlite":
+        # Versioned writes rely on UPDATE ... RETURNING
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(f"[ERROR] SQLite {sqlite3.sqlite_version} is too old for STATE_BACKEND=sqlite (needs 3.35+)")
+        return SQLiteSessionStore(config.STATE_DB, config.SESSION_IDLE_TTL_SECONDS, SWEEPER, config.SESSION_LEASE_SECONDS)
+    if config.STATE_BACKEND != "memory":
+        raise ValueError(f"[ERROR] Unknown STATE_BACKEND: {config.STATE_BACKEND}")
+    return SessionStore(config.SESSION_MAX, config.SESSION_IDLE_TTL_SECONDS, SWEEPER)
+
+
+STORE = open_store()
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import zlib
+import atexit
+import marshal
+import signal
+import threading
+
+import auth
+import config
+import features
+import log
+import otp
+import sessions
+
+LOG = log.get("snapshot")
+
+# marshal only carries plain data (no code runs on load); the header guards
+# against reading a file from an incompatible version
+MAGIC = b"PSBSNAP1"
+
+_lock = threading.Lock()
+
+
+def collect() -> dict:
+    return {
+        "written_at": time.time(),
+        "line_id": auth.LINE_ID_CACHE.dump(),
+        "usage": features.USAGE_CACHE.dump(),
+        "sessions": sessions.STORE.snapshot(),
+    }
+
+
+def write(path=config.SNAPSHOT_FILE):
+    started = time.perf_counter()
+    data = MAGIC + zlib.compress(marshal.dumps(collect()), 1)
+    tmp = path.with_suffix(".tmp")
+    with _lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Sessions and cached line ids are customer data: owner-only from the start,
+        # including a leftover tmp file that was created with wider permissions
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    LOG.info("wrote %d bytes in %.1f ms", len(data), (time.perf_counter() - started) * 1000)
+
+
+def read(path=config.SNAPSHOT_FILE) -> dict | None:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(MAGIC):
+        raise ValueError(f"not a snapshot file: {path}")
+    return marshal.loads(zlib.decompress(data[len(MAGIC):]))
+
+
+def restore(path=config.SNAPSHOT_FILE):
+    try:
+        snap = read(path)
+    except (OSError, ValueError, EOFError, TypeError, zlib.error) as e:
+        LOG.error("ignoring unreadable snapshot %s: %s", path, e)
+        return
+    if snap is None:
+        return
+    # Monotonic deadlines restart with the process, so every TTL is shortened by the downtime
+    elapsed = max(0.0, time.time() - snap["written_at"])
+    auth.LINE_ID_CACHE.load(snap["line_id"], elapsed)
+    features.USAGE_CACHE.load(snap["usage"], elapsed)
+    restored = sessions.STORE.restore(snap["sessions"], elapsed) if snap["sessions"] else []
+    for chat_id in restored:
+        otp.rearm(chat_id)
+    LOG.info(
+        "restored snapshot taken %.0f s ago", elapsed,
+        extra={"line_ids": len(snap["line_id"]), "usage": len(snap["usage"]), "sessions": len(restored)},
+    )
+
+
+def write_safely():
+    try:
+        write()
+    except (OSError, ValueError) as e:
+        LOG.error("write failed: %s", e)
+
+
+def on_sigterm(signum, frame):
+    # Unwind normally so the atexit hook writes the final snapshot
+    sys.exit(0)
+
+
+def start(interval: float = config.SNAPSHOT_INTERVAL_SECONDS):
+    restore()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            write_safely()
+
+    threading.Thread(target=run, name="snapshot", daemon=True).start()
+    atexit.register(write_safely)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, on_sigterm)
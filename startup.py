@@ -0,0 +1,25 @@
+import time
+
+import log
+
+LOG = log.get("startup")
+
+# Imported first by bot2, so the first phase covers the rest of its imports
+STARTED = time.perf_counter()
+PHASES = []
+
+_last = STARTED
+
+
+def mark(label: str):
+    global _last
+    now = time.perf_counter()
+    PHASES.append((label, now - _last))
+    _last = now
+
+
+def report():
+    LOG.info(
+        "ready in %.0f ms", (_last - STARTED) * 1000,
+        extra={"phases_ms": {label: round(seconds * 1000, 1) for label, seconds in PHASES}},
+    )
@@ -0,0 +1,202 @@
+import json
+import time
+import atexit
+import pathlib
+import sqlite3
+import threading
+from collections import Counter
+
+import config
+import log
+
+LOG = log.get("stat")
+
+STAT_DB = config.STAT_DIR / "stat.db"
+LEGACY_STAT_FILE = config.STAT_DIR / "stat.json"
+
+DEFAULT_BUTTONS = ("sales", "support", "usage", "coverage", "refresh")
+
+# Every increment is also counted in its minute and hour bucket
+RESOLUTIONS = {"minute": 60, "hour": 3600}
+
+
+class CounterStore:
+    def __init__(self, path: pathlib.Path, flush_interval: float, flush_threshold: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = Counter()
+        self._pending_buckets = Counter()
+        self._pending_total = 0
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._conn = None
+        self._thread = None
+
+    def connect(self) -> sqlite3.Connection:
+        with self._db_lock:
+            if self._conn is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS buckets ("
+                    "name TEXT NOT NULL, resolution TEXT NOT NULL, start INTEGER NOT NULL, value INTEGER NOT NULL, "
+                    "PRIMARY KEY (resolution, start, name))"
+                )
+                conn.commit()
+                self._conn = conn
+                self._import_legacy()
+            return self._conn
+
+    def _import_legacy(self):
+        if not LEGACY_STAT_FILE.exists():
+            return
+        if self._conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone():
+            return
+        try:
+            with open(LEGACY_STAT_FILE, "r") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            LOG.error("could not import %s: %s", LEGACY_STAT_FILE, e)
+            return
+        rows = [("visitors", int(legacy.get("visitors", 0)))]
+        rows += [(f"buttons.{k}", int(v)) for k, v in legacy.get("buttons", {}).items()]
+        with self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)", rows)
+        LOG.info("imported %d counters from %s", len(rows), LEGACY_STAT_FILE)
+
+    def incr(self, name: str, n: int = 1):
+        minute = int(time.time()) // 60 * 60
+        with self._lock:
+            self._pending[name] += n
+            self._pending_buckets[(name, minute)] += n
+            self._pending_total += n
+            full = self._pending_total >= self.flush_threshold
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            buckets, self._pending_buckets = self._pending_buckets, Counter()
+            self._pending_total = 0
+        if not pending:
+            return
+        rows = []
+        for resolution, seconds in RESOLUTIONS.items():
+            rolled = Counter()
+            for (name, minute), n in buckets.items():
+                rolled[(name, minute // seconds * seconds)] += n
+            rows += [(name, resolution, start, n) for (name, start), n in rolled.items()]
+        try:
+            conn = self.connect()
+            with self._db_lock, conn:
+                conn.executemany(
+                    "INSERT INTO counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    list(pending.items()),
+                )
+                conn.executemany(
+                    "INSERT INTO buckets (name, resolution, start, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(resolution, start, name) DO UPDATE SET value = value + excluded.value",
+                    rows,
+                )
+        except (sqlite3.Error, OSError) as e:
+            LOG.error("flush failed, keeping %d increments: %s", sum(pending.values()), e)
+            with self._lock:
+                self._pending.update(pending)
+                self._pending_buckets.update(buckets)
+                self._pending_total += sum(pending.values())
+            return
+        try:
+            self._prune()
+        except sqlite3.Error as e:
+            LOG.error("pruning minute buckets failed: %s", e)
+
+    def _prune(self):
+        # Minute buckets are only kept for recent history; hour buckets hold the long-term rollup
+        now = time.time()
+        if now - self._pruned_at < 600:
+            return
+        self._pruned_at = now
+        cutoff = int(now - config.STAT_MINUTE_RETENTION_SECONDS)
+        with self._db_lock, self._conn:
+            self._conn.execute("DELETE FROM buckets WHERE resolution = 'minute' AND start < ?", (cutoff,))
+
+    def totals(self) -> Counter:
+        conn = self.connect()
+        with self._db_lock:
+            rows = conn.execute("SELECT name, value FROM counters").fetchall()
+        totals = Counter(dict(rows))
+        with self._lock:
+            totals.update(self._pending)
+        return totals
+
+    def series(self, resolution: str, start: int, end: int) -> dict:
+        conn = self.connect()
+        with self._db_lock:
+            rows = conn.execute(
+                "SELECT name, start, value FROM buckets WHERE resolution = ? AND start >= ? AND start < ? ORDER BY start",
+                (resolution, start, end),
+            ).fetchall()
+        seconds = RESOLUTIONS[resolution]
+        points = Counter({(name, ts): value for name, ts, value in rows})
+        with self._lock:
+            for (name, minute), n in self._pending_buckets.items():
+                ts = minute // seconds * seconds
+                if start <= ts < end:
+                    points[(name, ts)] += n
+        series = {}
+        for (name, ts), value in sorted(points.items(), key=lambda item: item[0][1]):
+            series.setdefault(name, []).append([ts, value])
+        return series
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="stat-flush", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            # The thread is started once per process, so it must outlive any single failure
+            try:
+                self.flush()
+            except Exception as e:
+                LOG.error("flush thread error: %s", e)
+
+
+STORE = CounterStore(STAT_DB, config.STAT_FLUSH_INTERVAL_SECONDS, config.STAT_FLUSH_THRESHOLD)
+
+
+def increment_button(button_name: str):
+    STORE.incr(f"buttons.{button_name}")
+
+
+def increment_visitors():
+    STORE.incr("visitors")
+
+
+def load_stat() -> dict:
+    totals = STORE.totals()
+    buttons = {name: 0 for name in DEFAULT_BUTTONS}
+    for name, value in totals.items():
+        if name.startswith("buttons."):
+            buttons[name[len("buttons."):]] = value
+    return {"visitors": totals.get("visitors", 0), "buttons": buttons}
+
+
+def load_series(resolution: str, start: int, end: int) -> dict:
+    return STORE.series(resolution, start, end)
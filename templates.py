@@ -0,0 +1,128 @@
+import os
+import time
+import string
+import pathlib
+import threading
+
+import config
+import log
+
+LOG = log.get("templates")
+
+RESOURCES_DIR = pathlib.Path(__file__).resolve().parent / "resources"
+
+# Templates rendered with str.format and the placeholders they may use
+TEMPLATE_FIELDS = {
+    "usage": {"used", "total", "remaining"},
+    "usage_status": {"status"},
+    "refresh_failed": {"status"},
+    "usage_stale": {"age", "usage"},
+    "manager_enter_other_usage": {"max_numbers"},
+    "manager_enter_other_refresh": {"max_numbers"},
+    "bulk_not_registered": {"mdn"},
+    "bulk_unavailable": {"mdn"},
+    "bulk_usage_status": {"mdn", "status"},
+    "bulk_usage": {"mdn", "used", "total", "remaining"},
+    "bulk_usage_stale": {"mdn", "used", "total", "age"},
+    "bulk_refresh_success": {"mdn"},
+    "bulk_refresh_failed": {"mdn", "status"},
+    "bulk_refresh_queued": {"mdn"},
+    "bulk_refresh_cooldown": {"mdn"},
+    "bulk_processing": {"count"},
+    "bulk_skipped": {"skipped", "max_numbers"},
+    "bulk_usage_header": {"count"},
+    "bulk_refresh_header": {"count"},
+    "bulk_refresh_results_header": {"count"},
+}
+
+
+def placeholders(text: str) -> set:
+    return {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+
+
+def validate(name: str, text: str):
+    expected = TEMPLATE_FIELDS.get(name)
+    if expected is None:
+        return
+    try:
+        found = placeholders(text)
+    except ValueError as e:
+        raise ValueError(f"{name}: malformed placeholder: {e}")
+    unknown = found - expected
+    if unknown:
+        raise ValueError(f"{name}: unknown placeholders {sorted(unknown)}")
+
+
+class Template:
+    __slots__ = ("text", "mtime", "checked_at")
+
+    def __init__(self, text: str, mtime: float):
+        self.text = text
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+
+class TemplateRegistry:
+    def __init__(self, directory: pathlib.Path, check_interval: float = config.TEMPLATE_CHECK_SECONDS):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> pathlib.Path:
+        return self.directory / f"{name}.txt"
+
+    def _read(self, name: str) -> Template:
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf8") as file:
+            text = file.read()
+        validate(name, text)
+        return Template(text, mtime)
+
+    def load_all(self):
+        templates = {path.stem: self._read(path.stem) for path in sorted(self.directory.glob("*.txt"))}
+        with self._lock:
+            self._templates = templates
+        LOG.info("loaded %d templates from %s", len(templates), self.directory)
+
+    def get(self, name: str) -> str:
+        tpl = self._templates.get(name)
+        if tpl is None:
+            return self._load_new(name)
+        now = time.monotonic()
+        if now - tpl.checked_at >= self.check_interval:
+            tpl.checked_at = now
+            self._reload_if_changed(name, tpl)
+            tpl = self._templates[name]
+        return tpl.text
+
+    def _load_new(self, name: str) -> str:
+        if not self.path(name).exists():
+            raise FileNotFoundError(f"[ERROR] File not found: {self.path(name)}")
+        tpl = self._read(name)
+        with self._lock:
+            self._templates[name] = tpl
+        return tpl.text
+
+    def _reload_if_changed(self, name: str, tpl: Template):
+        try:
+            mtime = os.stat(self.path(name)).st_mtime
+        except OSError as e:
+            LOG.error("%s: keeping cached copy, stat failed: %s", name, e)
+            return
+        if mtime == tpl.mtime:
+            return
+        try:
+            fresh = self._read(name)
+        except (OSError, ValueError) as e:
+            LOG.error("%s: keeping cached copy, reload failed: %s", name, e)
+            tpl.mtime = mtime
+            return
+        with self._lock:
+            self._templates[name] = fresh
+        LOG.info("reloaded %s", name)
+
+
+REGISTRY = TemplateRegistry(RESOURCES_DIR)
+REGISTRY.load_all()
@@ -0,0 +1,48 @@
+import hmac
+import queue
+import threading
+
+import config
+import log
+
+LOG = log.get("webhook")
+
+UPDATES = queue.Queue(maxsize=config.WEBHOOK_QUEUE_SIZE)
+ACTIVE = threading.Event()
+
+stats = {"received": 0, "dropped": 0, "rejected": 0, "failed": 0}
+
+
+def check_secret(token: str | None) -> bool:
+    if not config.WEBHOOK_SECRET or token is None:
+        return False
+    return hmac.compare_digest(token.encode(), config.WEBHOOK_SECRET.encode())
+
+
+def enqueue(payload: dict) -> bool:
+    try:
+        UPDATES.put_nowait(payload)
+    except queue.Full:
+        stats["dropped"] += 1
+        return False
+    stats["received"] += 1
+    return True
+
+
+def drain(handler):
+    while True:
+        payload = UPDATES.get()
+        try:
+            handler(payload)
+        except Exception as e:
+            stats["failed"] += 1
+            LOG.error("update %s failed: %s", payload.get("update_id"), e)
+        finally:
+            UPDATES.task_done()
+
+
+def start(handler):
+    # A single drain thread keeps updates in arrival order on their way to the
+    # dispatcher lanes; it only parses and hands off, the lanes do the work
+    threading.Thread(target=drain, args=(handler,), name="webhook-drain", daemon=True).start()
+    ACTIVE.set()